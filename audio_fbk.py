@@ -1,9 +1,9 @@
-import imgui
 import numpy as np
 import pyo
 import sys
-from datetime import datetime
-from audio_utils import fdb, SampleVoices
+from time import perf_counter, thread_time
+from audio_utils import fdb, SampleVoices, GrainCloud, bank, curves
+from shader_ui import Param, ParamRegistry
 
 # note: to avoid glitches in audio, do not set values on pyo
 # objects directly during interaction.
@@ -14,28 +14,142 @@ from audio_utils import fdb, SampleVoices
 # can be configured (the default of 25ms is good for most purposes)
 
 
+class BlockStats:
+    """Per-block timing recorded from the server's block callback,
+    which pyo runs in the audio thread before computing each block.
+
+    The wall-clock interval between callbacks is the block period
+    (late callbacks, more than late_factor blocks apart, are counted
+    as probable underruns); the audio thread's CPU time over the same
+    interval is what the DSP actually cost"""
+
+    def __init__(self, block, n=1024, late_factor=1.5):
+        self.block = block
+        self.n = n
+        self.late_factor = late_factor
+        self.wall = np.zeros(n)
+        self.cpu = np.zeros(n)
+        self.count = 0
+        self.late = 0
+
+    def callback(self):
+        # keep this minimal: it holds the GIL inside the audio thread
+        i = self.count % self.n
+        self.wall[i] = perf_counter()
+        self.cpu[i] = thread_time()
+        if (
+            self.count
+            and self.wall[i] - self.wall[i - 1] > self.late_factor * self.block
+        ):
+            self.late += 1
+        self.count += 1
+
+    def stats(self):
+        """Summarise the last n blocks (times in microseconds)"""
+        n = min(self.count, self.n)
+        if n < 2:
+            return None
+        # unroll the ring into time order
+        order = np.arange(self.count - n, self.count) % self.n
+        period = np.diff(self.wall[order])
+        cost = np.diff(self.cpu[order])
+        p99 = np.percentile(period, 99)
+        return {
+            "blocks": self.count,
+            "block_us": self.block * 1e6,
+            "period_us": float(period.mean() * 1e6),
+            "period_p99_us": float(p99 * 1e6),
+            "dsp_us": float(cost.mean() * 1e6),
+            "dsp_max_us": float(cost.max() * 1e6),
+            "load": float(cost.sum() / period.sum()),
+            "underruns": self.late,
+        }
+
+
 class AudioServer:
-    def __init__(self, audio=False, device=-1, server="pa", winhost="mme"):
+    """Boot a pyo server. audio=True plays through the given
+    device, audio=False runs offline, and audio="manual" only
+    computes a block when process() is called (for offline rendering).
 
+    buffersize sets the block size (and so the latency,
+    buffersize / sr); instrument=True records per-block timing
+    (see BlockStats) at the cost of a Python call per block"""
+
+    def __init__(
+        self,
+        audio=False,
+        device=-1,
+        server="pa",
+        winhost="mme",
+        startup_sound=True,
+        sr=44100,
+        buffersize=256,
+        duplex=1,
+        instrument=False,
+    ):
+        settings = {"sr": sr, "buffersize": buffersize, "duplex": duplex}
         # boot the server
-        if audio == False:
+        if audio == "manual":
+            self.server = pyo.Server(audio="manual", **settings)
+        elif audio == False:
             # no audio in this case
-            self.server = pyo.Server(audio="offline_nb")
+            self.server = pyo.Server(audio="offline_nb", **settings)
         else:
             if sys.platform == "win32":
-                self.server = pyo.Server(winhost=winhost, audio=server)
+                self.server = pyo.Server(winhost=winhost, audio=server, **settings)
             else:
-                self.server = pyo.Server(audio=server)
+                self.server = pyo.Server(audio=server, **settings)
 
             # set audio id requested
             if device != -1:
                 self.server.setOutputDevice(device)
+        self.block = buffersize / sr
+        self.manual = audio == "manual"
+        self.blocks = 0
+        self.callbacks = []
+        self.block_stats = None
+        if instrument:
+            self.block_stats = BlockStats(self.block)
+            self.add_callback(self.block_stats.callback)
         self.server.boot().start()
         # make sure we know we are alive
         # play a startup sound
-        self.startup = pyo.SfPlayer(
-            "sounds/startup.wav", loop=False, speed=1, mul=0.4
-        ).out()
+        if startup_sound:
+            self.startup = pyo.SfPlayer(
+                "sounds/startup.wav", loop=False, speed=1, mul=0.4
+            ).out()
+
+    def add_callback(self, fn):
+        """Call fn at the start of every audio block, in the audio
+        thread. Callbacks hold the GIL there, so keep them short"""
+        if not self.callbacks:
+            self.server.setCallback(self._run_callbacks)
+        self.callbacks.append(fn)
+
+    def _run_callbacks(self):
+        for fn in self.callbacks:
+            fn()
+
+    def stats(self):
+        """Live block timing (None unless instrumented), plus the
+        number of pyo objects the server is computing"""
+        stats = {"streams": self.server.getNumberOfStreams()}
+        if self.block_stats is not None:
+            stats.update(self.block_stats.stats() or {})
+        return stats
+
+    def process(self):
+        """Compute one block (manual mode only)"""
+        self.server.process()
+        self.blocks += 1
+
+    def time(self):
+        """Audio time in seconds: the blocks computed so far in
+        manual mode (which can run faster or slower than realtime),
+        otherwise the wall clock, which a device server follows"""
+        if self.manual:
+            return self.blocks * self.block
+        return perf_counter()
 
     def close(self):
         # kill the audio
@@ -49,33 +163,293 @@ class AudioServer:
         self.server.start()
 
 
+class ControlScheduler:
+    """Collect parameter writes and send them to pyo once per
+    frame or block (flush()), instead of on every input event.
+
+    Each parameter has a target with setValue() (normally a SigTo),
+    and a mapping from the raw input value:
+        offset + scale * curve(in_scale * value + in_offset)
+    where curve is one of audio_utils.curves. Only the latest value
+    of each parameter is kept; on flush, all pending values are
+    mapped with one vectorised call per curve, and only values that
+    actually changed are sent."""
+
+    def __init__(self):
+        self.names = {}
+        self.targets = []
+        self.params = []
+        self.groups = {}
+        self.pending = np.zeros(0)
+        self.dirty = np.zeros(0, dtype=bool)
+        self.sent = np.zeros(0)
+
+    def add(
+        self,
+        name,
+        target,
+        curve="linear",
+        in_scale=1.0,
+        in_offset=0.0,
+        scale=1.0,
+        offset=0.0,
+    ):
+        self.names[name] = len(self.targets)
+        self.targets.append(target)
+        self.params.append((curve, in_scale, in_offset, scale, offset))
+        # rebuild the per-curve index and coefficient arrays
+        params = np.array([p[1:] for p in self.params], dtype=np.float64)
+        self.in_scale, self.in_offset, self.scale, self.offset = params.T
+        curve_of = np.array([p[0] for p in self.params])
+        self.groups = {c: np.flatnonzero(curve_of == c) for c in set(curve_of)}
+        self.pending = np.append(self.pending, 0.0)
+        self.dirty = np.append(self.dirty, False)
+        self.sent = np.append(self.sent, np.nan)
+
+    def set(self, name, value):
+        i = self.names[name]
+        self.pending[i] = value
+        self.dirty[i] = True
+
+    def flush(self):
+        """Map every pending value and send the ones that changed"""
+        if not self.dirty.any():
+            return
+        mapped = np.full(len(self.targets), np.nan)
+        for curve, members in self.groups.items():
+            members = members[self.dirty[members]]
+            if len(members):
+                x = self.in_scale[members] * self.pending[members]
+                y = curves[curve](x + self.in_offset[members])
+                mapped[members] = self.offset[members] + self.scale[members] * y
+        self.dirty[:] = False
+        for i in np.flatnonzero(mapped != self.sent):
+            if not np.isnan(mapped[i]):
+                self.targets[i].setValue(float(mapped[i]))
+                self.sent[i] = mapped[i]
+
+
+def pyo_graph(root):
+    """Collect every pyo object reachable from the attributes of
+    root, following the inputs and parameters each pyo object
+    holds (so inline expressions like a * b are found too)"""
+    found = {}
+    stack = list(vars(root).values())
+    while stack:
+        obj = stack.pop()
+        if isinstance(obj, (list, tuple)):
+            stack.extend(obj)
+        elif isinstance(obj, dict):
+            stack.extend(obj.values())
+        elif isinstance(obj, pyo.PyoObject):
+            if id(obj) not in found:
+                found[id(obj)] = obj
+                stack.extend(vars(obj).values())
+        elif hasattr(obj, "pyo_objects"):
+            # helpers such as SampleVoices
+            stack.extend(obj.pyo_objects())
+    return list(found.values())
+
+
 class AudioFbk:
-    def __init__(self, server):
+    """Base class for audio feedback graphs. Subclasses send their
+    output through route(), which applies a crossfade gain, so
+    graphs can be swapped in and out without stopping the server"""
+
+    def __init__(self, server, fade_time=0.05):
         self.server = server.server
-        self.gains = {}
+        # user-adjustable gains, see add_gain()
+        self.params = ParamRegistry()
+        # last control input, e.g. for publishing downstream
+        self.state = np.zeros(2, dtype=np.float32)
+        self.fade_time = fade_time
+        self.fader = pyo.SigTo(0.0, time=fade_time)
+        self.outputs = []
+        self.mix = None
+        self.suspended = []
+        self.samples = []
+        self.controls = ControlScheduler()
+
+    def update(self):
+        """Send control and gain changes made since the last update;
+        called once per frame (or per block when rendering offline)"""
+        self.controls.flush()
+        self.params.update()
+
+    def sample(self, path):
+        """Get a shared table for a sound file from the sample bank"""
+        table = bank.acquire(path)
+        self.samples.append(table)
+        return table
+
+    def close(self):
+        """Stop the graph and hand its samples back to the bank"""
+        self.suspend()
+        for table in self.samples:
+            bank.release(table)
+        self.samples = []
+
+    def route(self, sig):
+        """Send sig to the output, through the crossfade gain"""
+        out = sig * self.fader
+        self.outputs.append(out.out())
+        return out
+
+    def objects(self):
+        """(total, playing) counts of the pyo objects in this graph"""
+        objects = pyo_graph(self)
+        return len(objects), sum(obj.isPlaying() for obj in objects)
+
+    def output(self):
+        """The graph's whole (faded) output, e.g. for analysis"""
+        if self.mix is None:
+            self.mix = sum(self.outputs) if self.outputs else pyo.Sig(0.0)
+        return self.mix
+
+    def fade_in(self):
+        self.resume()
+        self.fader.setValue(1.0)
+
+    def fade_out(self):
+        self.fader.setValue(0.0)
+
+    def suspend(self):
+        """Stop every pyo object in the graph, so an inactive
+        graph costs no DSP time"""
+        playing = [obj for obj in pyo_graph(self) if obj.isPlaying()]
+        for obj in playing:
+            obj.stop()
+        # one-shot players would restart from the top if replayed
+        self.suspended += [obj for obj in playing if not isinstance(obj, pyo.TableRead)]
+
+    def resume(self):
+        for obj in self.suspended:
+            obj.play()
+        for out in self.outputs:
+            out.out()
+        self.suspended = []
+
+    def set_state(self, x, y):
+        self.state[:] = x, y
+
+    def ping(self):
+        pass
+
+    def events(self, count, values=None):
+        """React to count incoming events (values is the decoded
+        packet or merged batch, if any). By default, a single ping"""
+        if count:
+            self.ping()
 
     def add_gain(self, name, elt, gain=0.0):
         """Register a decibel gain for a given
-        element. Sets the elements mul
-        property based on inputs from a slider
-        (specified in dB)"""
-        self.gains[name] = (gain, elt)
+        element. The element's mul is driven by a SigTo,
+        which is set (smoothly) only when the gain changes"""
+        level = pyo.SigTo(fdb(gain), time=0.025)
+        elt.mul = level
+        self.params.add(
+            Param(
+                name,
+                lambda db: level.setValue(fdb(db)),
+                init=gain,
+                min=-40.0,
+                max=0.0,
+                format="%.0f",
+            )
+        )
 
     def gain_sliders(self):
         """Create sliders for any adjustable gains"""
-        for name in self.gains:
-            db, elt = self.gains[name]
-            _, db = imgui.slider_float(name.title() + " dB", db, -40, 0.0, "%.0f", 1.0)
-            self.gains[name] = (db, elt)
-            elt.mul = fdb(db)
+        for name in self.params.params:
+            self.params.slider(name, name.title() + " dB")
+
+
+class FeedbackBank:
+    """Cache of feedback graphs, one per feedback class, built
+    up front (prebuild=True) or on first use. Switching crossfades
+    between graphs without stopping the server; a graph that has
+    faded out is suspended by update(), which should be called
+    once per frame"""
+
+    def __init__(
+        self, server, feedbacks, prebuild=False, fade_time=0.05, analysis=None
+    ):
+        self.server = server
+        # AudioAnalysis that follows the active graph
+        self.analysis = analysis
+        self.feedbacks = feedbacks
+        self.fade_time = fade_time
+        self.graphs = {}
+        self.active = None
+        # (time to suspend, graph) for graphs fading out
+        self.fading = []
+        if prebuild:
+            for fbk in feedbacks.values():
+                self.get(fbk)
+
+    def get(self, fbk):
+        """Return the (suspended or active) graph for a feedback class"""
+        if fbk not in self.graphs:
+            graph = fbk(self.server, fade_time=self.fade_time)
+            graph.suspend()
+            self.graphs[fbk] = graph
+        return self.graphs[fbk]
+
+    def set(self, fbk):
+        """Crossfade to the given feedback class, returning its graph"""
+        graph = self.get(fbk)
+        if graph is self.active:
+            return graph
+        if self.active is not None:
+            self.active.fade_out()
+            # allow the ramp to finish before stopping the graph
+            self.fading.append((perf_counter() + 2 * self.fade_time, self.active))
+        self.fading = [(t, g) for t, g in self.fading if g is not graph]
+        graph.fade_in()
+        if self.analysis is not None:
+            self.analysis.set_input(graph.output(), self.fade_time)
+        self.active = graph
+        return graph
+
+    def update(self):
+        if self.active is not None:
+            self.active.update()
+        now = perf_counter()
+        for t, graph in self.fading:
+            if t < now:
+                graph.suspend()
+        self.fading = [(t, g) for t, g in self.fading if t >= now]
+
+    def preset(self):
+        """{feedback name: {gain: dB}} for every graph built so far"""
+        return {
+            name: self.graphs[fbk].params.preset()
+            for name, fbk in self.feedbacks.items()
+            if fbk in self.graphs
+        }
+
+    def apply(self, preset):
+        """Restore gains saved by preset(), building graphs as needed"""
+        for name, values in preset.items():
+            if name in self.feedbacks:
+                self.get(self.feedbacks[name]).params.apply(values)
+
+    def objects(self):
+        """{feedback name: (total, playing)} pyo object counts
+        for every graph built so far"""
+        return {
+            name: self.graphs[fbk].objects()
+            for name, fbk in self.feedbacks.items()
+            if fbk in self.graphs
+        }
 
 
 class WindFbk(AudioFbk):
     """Noise generator with moving
     resonant filter"""
 
-    def __init__(self, server):
-        super().__init__(server)
+    def __init__(self, server, **kwargs):
+        super().__init__(server, **kwargs)
 
         self.noise = pyo.Noise()
         self.freq = pyo.SigTo(1000.0)
@@ -85,25 +459,86 @@ class WindFbk(AudioFbk):
         self.filter = pyo.Resonx(self.lp_filter, freq=self.freq, q=self.q)
 
         self.main_gain = pyo.SigTo(0.0, time=0.1)
-        self.voices = SampleVoices(16)
+        self.voices = SampleVoices(16, clock=server.time)
 
         self.delay = pyo.Delay(
             self.filter * self.main_gain * 2.0, feedback=0.2, delay=0.4
         )
         self.compressor = pyo.Compress(self.delay)
 
-        
-        self.tick_sound = pyo.SndTable("sounds/ping.wav")
-        self.out = self.compressor + self.voices.get_output()
-        self.out.out()
+        self.tick_sound = self.sample("sounds/ping.wav")
+        self.ticks = self.voices.get_output()
+        self.out = self.route(self.compressor + self.ticks)
+        self.add_gain("wind", self.compressor)
+        self.add_gain("ticks", self.ticks)
+
+        # y drives the lowpass, gain and resonance through tanh(2y), x the frequency
+        c = self.controls
+        c.add(
+            "lp_freq", self.lp_freq, "tanh", in_scale=2.0, scale=-1000.0, offset=1000.0
+        )
+        c.add("main_gain", self.main_gain, "tanh", in_scale=2.0, scale=-1.0, offset=1.0)
+        c.add("q", self.q, "tanh", in_scale=2.0, scale=-2.0, offset=2.0)
+        c.add("freq", self.freq, "exp", in_scale=3.0, in_offset=-1.5, scale=1000.0)
 
     def ping(self):
         self.voices.play(self.tick_sound)
 
-
     def set_state(self, x, y):
-        y = float(np.tanh(y * 2.0))
-        self.lp_freq.setValue((1 - y) * 1000.0)
-        self.main_gain.setValue(1-y)
-        self.freq.setValue(1000.0 * float(np.exp((x - 0.5) * 3.0)))
-        self.q.setValue(2 * (1 - y))
+        super().set_state(x, y)
+        # applied on the next update()
+        for name in ("lp_freq", "main_gain", "q"):
+            self.controls.set(name, y)
+        self.controls.set("freq", x)
+
+
+class GrainFbk(AudioFbk):
+    """Event-driven grain cloud: every incoming event spawns
+    a burst of grains around the current x (source position)
+    and y (pitch), scheduled as one batch"""
+
+    def __init__(self, server, grains_per_event=8, max_burst=512, **kwargs):
+        super().__init__(server, **kwargs)
+        self.grains_per_event = grains_per_event
+        self.max_burst = max_burst
+        self.rng = np.random.default_rng()
+        self.source = self.sample("sounds/pulse.wav")
+        self.cloud = GrainCloud(self.source, self.server, dur=0.03)
+        self.grains = self.cloud.get_output()
+        self.out = self.route(self.grains)
+        self.add_gain("grains", self.grains)
+
+    def update(self):
+        super().update()
+        self.cloud.update()
+
+    def ping(self):
+        self.events(1)
+
+    def events(self, count, values=None):
+        n = min(count * self.grains_per_event, self.max_burst)
+        if not n:
+            return
+        x, y = self.state
+        # positions from the events themselves, if they carry x
+        if (
+            isinstance(values, np.ndarray)
+            and values.dtype.names
+            and "x" in values.dtype.names
+        ):
+            x = np.resize(values["x"], n)
+        rng = self.rng
+        self.cloud.schedule(
+            rng.uniform(0.0, 0.03, n),
+            x + rng.normal(0.0, 0.02, n),
+            2.0 ** (rng.normal(0.0, 0.1, n) + 1.0 - 2.0 * y),
+            1.0 / np.sqrt(n),
+        )
+
+
+# every feedback type, by name
+feedbacks = {
+    "None": AudioFbk,
+    "Wind": WindFbk,
+    "Grains": GrainFbk,
+}
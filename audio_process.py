@@ -0,0 +1,364 @@
+import struct
+import time
+from multiprocessing import Pipe, Process
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+from audio_fbk import AudioServer, FeedbackBank
+from shader_ui import Param, ParamRegistry
+from shm_ring import ShmRing, _attach
+
+# Host the pyo server and the feedback graphs in a child process, so
+# render-thread stalls (GC, shader compiles, UI rebuilds) never delay
+# audio control. The parent writes into a fixed-layout shared-memory
+# control block and a trigger ring; a pyo block callback in the child
+# applies them at the start of every audio block.
+
+# most gains any one feedback may register
+MAX_GAINS = 8
+
+# live statistics written back by the child
+stat_keys = (
+    "streams",
+    "blocks",
+    "block_us",
+    "period_us",
+    "period_p99_us",
+    "dsp_us",
+    "dsp_max_us",
+    "load",
+    "underruns",
+)
+
+# trigger messages: a ping, or a batch of events with its count
+PING = b"\x01"
+EVENTS = 2
+events_msg = struct.Struct("<BI")
+
+
+def control_dtype(n_feedbacks):
+    """Layout of the shared control block. Single writer per field:
+    the parent writes the controls, the child the objects and stats"""
+    return np.dtype(
+        [
+            ("feedback", "i4"),
+            ("x", "f4"),
+            ("y", "f4"),
+            # NaN until the parent sets a gain
+            ("gains", "f4", (n_feedbacks, MAX_GAINS)),
+            ("objects", "i4", (n_feedbacks, 2)),
+            ("stats", "f8", (len(stat_keys),)),
+        ]
+    )
+
+
+class ControlBlock:
+    """The control block in its own shared memory, created by the
+    parent. Pickles by name (like ShmRing), so a spawned child
+    attaches to the same block"""
+
+    def __init__(self, n_feedbacks, name=None):
+        self.n_feedbacks = n_feedbacks
+        self.owner = name is None
+        dtype = control_dtype(n_feedbacks)
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=dtype.itemsize)
+        else:
+            self.shm = _attach(name)
+        self.array = np.ndarray((), dtype, self.shm.buf)
+        if self.owner:
+            self.array["feedback"] = -1
+            self.array["x"] = self.array["y"] = 0.0
+            self.array["gains"] = np.nan
+            self.array["objects"] = 0
+            self.array["stats"] = 0
+
+    def __getstate__(self):
+        return {"name": self.shm.name, "n_feedbacks": self.n_feedbacks}
+
+    def __setstate__(self, state):
+        self.__init__(state["n_feedbacks"], state["name"])
+
+    def close(self):
+        del self.array
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+class _Controller:
+    """Child side: applies the control block and triggers
+    once per audio block, from the server callback"""
+
+    def __init__(self, server, bank, names, block, ring, stats_every=64):
+        self.server = server
+        self.bank = bank
+        self.names = names
+        self.block = block
+        self.ring = ring
+        self.stats_every = stats_every
+        self.feedback = -1
+        self.x = self.y = np.nan
+        self.gains = np.full_like(block["gains"], np.nan)
+        self.count = 0
+        self.objects_at = -np.inf
+
+    def callback(self):
+        block = self.block
+        if block["feedback"] != self.feedback:
+            self.feedback = int(block["feedback"])
+            self.bank.set(self.bank.feedbacks[self.names[self.feedback]])
+        graph = self.bank.active
+        x, y = block["x"], block["y"]
+        if graph is not None and (x != self.x or y != self.y):
+            self.x, self.y = x, y
+            graph.set_state(float(x), float(y))
+        gains = block["gains"]
+        changed = np.flatnonzero((gains != self.gains) & ~np.isnan(gains))
+        if len(changed):
+            self.apply_gains(changed)
+        for msg in self.ring.drain():
+            # triggers sent before any feedback is selected are dropped
+            if graph is None:
+                continue
+            if msg == PING:
+                graph.ping()
+            elif msg[0] == EVENTS:
+                graph.events(events_msg.unpack(msg)[1])
+        self.ring.release()
+        self.bank.update()
+        self.count += 1
+        if self.count % self.stats_every == 0:
+            self.write_stats()
+
+    def apply_gains(self, changed):
+        gains = self.block["gains"]
+        for flat in changed:
+            i, j = divmod(int(flat), MAX_GAINS)
+            value = gains[i, j]
+            self.gains[i, j] = value
+            graph = self.bank.get(self.bank.feedbacks[self.names[i]])
+            graph.params.set(list(graph.params.params)[j], float(value))
+
+    def write_stats(self):
+        stats = self.server.stats()
+        self.block["stats"] = [stats.get(key, 0) for key in stat_keys]
+        # object counts are a graph walk, so refresh them about once
+        # a second (as often as the parent shows them)
+        now = time.perf_counter()
+        if now - self.objects_at >= 1.0:
+            self.objects_at = now
+            for i, counts in enumerate(self.bank.objects().values()):
+                self.block["objects"][i] = counts
+
+
+def _audio_main(control, ring, conn, feedbacks, server_kwargs):
+    names = list(feedbacks)
+    block = control.array
+    server = AudioServer(**server_kwargs)
+    bank = FeedbackBank(server, feedbacks, prebuild=True)
+    # report each feedback's gains (name, initial dB) to the parent
+    conn.send(
+        {
+            name: [
+                (param.name, param.value)
+                for param in bank.get(fbk).params.params.values()
+            ][:MAX_GAINS]
+            for name, fbk in feedbacks.items()
+        }
+    )
+    controller = _Controller(server, bank, names, block, ring)
+    server.add_callback(controller.callback)
+    # run until the parent asks us to stop; the parent owns (and
+    # unlinks) the shared memory, so it is left mapped until exit
+    try:
+        if server_kwargs.get("audio") == "manual":
+            # no device: pace the blocks ourselves, against absolute
+            # deadlines so the DSP time does not add to every period
+            period = server.block
+            deadline = time.perf_counter()
+            while True:
+                deadline += period
+                now = time.perf_counter()
+                if now - deadline > 4 * period:
+                    # far behind (a stall): skip ahead, don't burst
+                    deadline = now
+                if conn.poll(max(0.0, deadline - now)):
+                    break
+                server.process()
+        else:
+            conn.recv()
+    except EOFError:
+        pass
+    server.close()
+
+
+class RemoteFbk:
+    """Parent-side stand-in for a feedback graph running in the
+    audio process, with the same control API as AudioFbk"""
+
+    def __init__(self, process, index, gains):
+        self.process = process
+        self.index = index
+        self.state = np.zeros(2, dtype=np.float32)
+        self.params = ParamRegistry()
+        for j, (name, db) in enumerate(gains):
+            self.params.add(
+                Param(
+                    name,
+                    self._gain_target(j),
+                    init=db,
+                    min=-40.0,
+                    max=0.0,
+                    format="%.0f",
+                )
+            )
+
+    def _gain_target(self, j):
+        def push(db):
+            self.process.block["gains"][self.index, j] = db
+
+        return push
+
+    def set_state(self, x, y):
+        self.state[:] = x, y
+        block = self.process.block
+        block["x"], block["y"] = x, y
+
+    def ping(self):
+        # never blocks: a full ring drops the trigger
+        self.process.ring.put(PING, timeout=0)
+
+    def events(self, count, values=None):
+        # only the count crosses to the audio process, not the values
+        if count:
+            self.process.ring.put(events_msg.pack(EVENTS, count), timeout=0)
+
+    def update(self):
+        self.params.update()
+
+    def gain_sliders(self):
+        for name in self.params.params:
+            self.params.slider(name, name.title() + " dB")
+
+
+class RemoteBank:
+    """Parent-side stand-in for the FeedbackBank in the audio process"""
+
+    def __init__(self, process, gains):
+        self.process = process
+        self.feedbacks = process.feedbacks
+        self.graphs = {
+            fbk: RemoteFbk(process, i, gains[name])
+            for i, (name, fbk) in enumerate(self.feedbacks.items())
+        }
+        self.active = None
+
+    def get(self, fbk):
+        return self.graphs[fbk]
+
+    def set(self, fbk):
+        """Switch (crossfade, in the audio process) to the given feedback"""
+        graph = self.graphs[fbk]
+        self.process.block["feedback"] = graph.index
+        self.active = graph
+        return graph
+
+    def update(self):
+        for graph in self.graphs.values():
+            graph.update()
+
+    def preset(self):
+        return {
+            name: self.graphs[fbk].params.preset()
+            for name, fbk in self.feedbacks.items()
+        }
+
+    def apply(self, preset):
+        for name, values in preset.items():
+            if name in self.feedbacks:
+                self.graphs[self.feedbacks[name]].params.apply(values)
+
+    def objects(self):
+        counts = self.process.block["objects"]
+        return {
+            name: tuple(int(n) for n in counts[i])
+            for i, name in enumerate(self.feedbacks)
+        }
+
+
+class AudioProcess:
+    """Run an AudioServer and a FeedbackBank of feedbacks in a child
+    process. Takes the same keyword arguments as AudioServer; the
+    feedback graphs are driven through bank (a RemoteBank)"""
+
+    def __init__(self, feedbacks, timeout=10.0, **server_kwargs):
+        self.feedbacks = feedbacks
+        self.control = ControlBlock(len(feedbacks))
+        self.block = self.control.array
+        # "block" policy: no lock, put(timeout=0) drops when full
+        self.ring = ShmRing(n_slots=256, slot_size=16, policy="block")
+        self.conn, child_conn = Pipe()
+        self.process = Process(
+            target=_audio_main,
+            args=(self.control, self.ring, child_conn, feedbacks, server_kwargs),
+            daemon=True,
+        )
+        self.process.start()
+        if not self.conn.poll(timeout):
+            self.close()
+            raise RuntimeError("Audio process did not start")
+        self.bank = RemoteBank(self, self.conn.recv())
+
+    def alive(self):
+        return self.process.is_alive()
+
+    def stats(self):
+        """Statistics from the audio process, as AudioServer.stats()"""
+        values = dict(zip(stat_keys, self.block["stats"].tolist()))
+        stats = {"streams": int(values["streams"])}
+        if values["blocks"]:
+            values.pop("streams")
+            stats.update(values)
+        return stats
+
+    def close(self, timeout=2.0):
+        if self.process.is_alive():
+            self.conn.send("close")
+            self.process.join(timeout)
+            if self.process.is_alive():
+                self.process.terminate()
+        del self.block
+        self.ring.close()
+        self.control.close()
+
+
+if __name__ == "__main__":
+    # drive the audio process from a deliberately stalling "render loop"
+    import argparse
+    from audio_fbk import feedbacks
+
+    parser = argparse.ArgumentParser(description="Isolated audio process test")
+    parser.add_argument("--seconds", type=float, default=5.0)
+    parser.add_argument("--stall_ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    audio = AudioProcess(feedbacks, audio=True, instrument=True, startup_sound=False)
+    graph = audio.bank.set(feedbacks["Wind"])
+    start = time.perf_counter()
+    frame = 0
+    while time.perf_counter() - start < args.seconds:
+        t = time.perf_counter() - start
+        graph.set_state(0.5 + 0.4 * np.sin(t), 0.5 + 0.4 * np.cos(t))
+        if frame % 10 == 0:
+            graph.ping()
+        if frame % 60 == 0:
+            # simulate a render-thread spike
+            time.sleep(args.stall_ms / 1000.0)
+        audio.bank.update()
+        time.sleep(1 / 60)
+        frame += 1
+    print(audio.stats())
+    audio.close()
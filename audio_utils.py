@@ -1,8 +1,13 @@
+import os
+import weakref
 import pyo
-import numpy
-from datetime import datetime
+import numpy as np
+from collections import OrderedDict
+from time import perf_counter
+
 
 # Some basic transfer functions
+# (these all work elementwise on numpy arrays as well as scalars)
 def fdb(db):
     """Convert a decibel value to a float"""
     return 10 ** (db / 10.0)
@@ -22,24 +27,107 @@ def squanch(x, ctr=0.5, shape=1.0, sign=1):
     centred on ctr. shape determines sharpness
     sign inverts direction if = -1.
     """
-    return float(0.5 + 0.5 * sign * np.tanh((x - ctr) * shape))
+    y = 0.5 + 0.5 * sign * np.tanh((x - ctr) * shape)
+    return float(y) if np.ndim(y) == 0 else y
+
+
+# curves for ControlScheduler mappings, out = offset + scale * f(in_scale * x + in_offset)
+# (so e.g. squanch(x, ctr, shape, sign) is "tanh" with in_scale=shape,
+# in_offset=-ctr*shape, scale=0.5*sign, offset=0.5)
+curves = {
+    "linear": lambda x: x,
+    "tanh": np.tanh,
+    "exp": np.exp,
+    "sigmoid": sigmoid,
+    "fdb": fdb,
+}
+
+
+class SampleBank:
+    """Process-wide cache of sample tables, so each file is read from
+    disk once, however many feedbacks or granulators use it.
+
+    Tables are keyed by path, modification time and size (so an
+    edited file is reloaded), loaded on first acquire(), shared, and
+    reference counted. Unreferenced tables are kept for reuse until
+    the total size exceeds `budget` bytes, then evicted least recently
+    used first. Files too large to hold in memory can be loaded a
+    region at a time (start/stop)."""
+
+    def __init__(self, budget=256 * 2**20):
+        self.budget = budget
+        # key -> [table, refs, nbytes], in least recently used order
+        self.entries = OrderedDict()
+        self.keys = {}
+        self.loads = 0
+
+    def key(self, path, start=0.0, stop=None):
+        path = os.path.abspath(path)
+        st = os.stat(path)
+        return (path, st.st_mtime_ns, st.st_size, start, stop)
+
+    def nbytes(self):
+        return sum(entry[2] for entry in self.entries.values())
+
+    def acquire(self, path, start=0.0, stop=None):
+        """Return the shared table for (a region of) a sound file"""
+        key = self.key(path, start, stop)
+        if key not in self.entries:
+            kwargs = (
+                {"start": start} if stop is None else {"start": start, "stop": stop}
+            )
+            table = pyo.SndTable(key[0], **kwargs)
+            chnls = pyo.sndinfo(key[0])[3]
+            # pyo tables hold 32 bit samples
+            self.entries[key] = [table, 0, table.getSize() * chnls * 4]
+            self.loads += 1
+        entry = self.entries[key]
+        entry[1] += 1
+        self.entries.move_to_end(key)
+        self.keys[id(entry[0])] = key
+        self.evict()
+        return entry[0]
+
+    def release(self, table):
+        """Drop a reference taken by acquire()"""
+        key = self.keys.get(id(table))
+        if key in self.entries:
+            self.entries[key][1] -= 1
+        self.evict()
+
+    def evict(self):
+        total = self.nbytes()
+        for key in list(self.entries):
+            if total <= self.budget:
+                break
+            table, refs, nbytes = self.entries[key]
+            if refs <= 0:
+                del self.entries[key]
+                del self.keys[id(table)]
+                total -= nbytes
+
+
+# shared by everything in this process
+bank = SampleBank()
 
 
 def make_granulator(snd_file):
     """Construct a synchronous
     granulator object from a given sound file"""
-    base_sound = pyo.SndTable(snd_file)
+    base_sound = bank.acquire(snd_file)
     env = pyo.WinTable(0)  # env. turned off
     # slight randomised pitcch
     ptch = pyo.Randi(min=0.95, max=1.05, freq=100)
     gr = pyo.Granule(base_sound, env, dens=2.0, pitch=ptch, mul=0.01, dur=0.1)
+    # hand the table back to the bank once the granulator is dropped
+    weakref.finalize(gr, bank.release, base_sound)
     return gr
 
 
 def texture_granulator(snd_file, dur=0.25):
     """Construct a dense asynchronous
     granulator object from a given sound file"""
-    base_sound = pyo.SndTable(snd_file)
+    base_sound = bank.acquire(snd_file)
     env = pyo.HannTable()  # smooth grains
     end = base_sound.getSize() - dur * 44100
     pos = pyo.Randi(min=0, max=1, freq=[0.25, 0.3], mul=end)
@@ -47,31 +135,468 @@ def texture_granulator(snd_file, dur=0.25):
     # dense cloud, and not synchronised
     gr = pyo.Granule(base_sound, env, dens=20.0, mul=smoother, pos=pos, dur=dur)
     gr.setSync(False)
+    weakref.finalize(gr, bank.release, base_sound)
     return gr, smoother
 
 
 class SampleVoices:
-    """Manage polyphony when playing multiple samples,
-    by using the least recently used sample player to
-    trigger a sample"""
+    """Manage polyphony when playing multiple samples.
 
-    def __init__(self, n=32):
+    Voices are allocated in constant time, on a monotonic clock
+    (clock() in seconds; pass the audio server's clock when blocks
+    are not computed in realtime):
+    steal="oldest" reuses voices round-robin (least recently
+    triggered first), "quietest" reuses the voice with the lowest
+    estimated remaining level, and "retrigger" restarts the voice
+    already playing the same sample, if there is one.
+
+    Triggers of a sample within `coalesce` seconds of the last
+    trigger of that sample (about one 256 sample block at 44.1kHz
+    by default) are folded into the voice already playing, raising
+    its gain instead of using up another voice (so "quietest" never
+    steals a voice inside that window). If max_rate is set,
+    triggers beyond max_rate per second are dropped."""
+
+    def __init__(
+        self,
+        n=32,
+        steal="oldest",
+        coalesce=0.006,
+        max_rate=None,
+        max_mul=2.0,
+        clock=perf_counter,
+    ):
+        if steal not in ("oldest", "quietest", "retrigger"):
+            raise ValueError(f"Unknown voice stealing policy {steal}")
         self.n = n
+        self.steal = steal
+        self.coalesce = coalesce
+        self.max_rate = max_rate
+        self.max_mul = max_mul
+        self.clock = clock
         self.dummy_tab = pyo.HannTable()
-        self.voices = [
-            (datetime.now(), pyo.TableRead(self.dummy_tab, freq=2)) for i in range(n)
-        ]
+        self.players = [pyo.TableRead(self.dummy_tab, freq=2) for i in range(n)]
+        # per-voice trigger time, gain and duration, and the table playing
+        self.start = np.full(n, -np.inf)
+        self.mul = np.zeros(n)
+        self.dur = np.ones(n)
+        self.tables = [None] * n
+        self.next = 0
+        # last voice used by each table, and each table's (rate, duration)
+        self.last = {}
+        self.rates = {}
+        # token bucket for rate limiting
+        self.tokens = 1.0
+        self.refilled = clock()
+        self.triggered = 0
+        self.coalesced = 0
+        self.limited = 0
+
+    def allow(self, now):
+        """Take a token from the rate limiter, if there is one"""
+        if self.max_rate is None:
+            return True
+        burst = max(1.0, self.max_rate / 10.0)
+        self.tokens = min(burst, self.tokens + (now - self.refilled) * self.max_rate)
+        self.refilled = now
+        if self.tokens < 1.0:
+            return False
+        self.tokens -= 1.0
+        return True
+
+    def allocate(self, tab, now):
+        """Choose the voice to (re)use for tab"""
+        last = self.last.get(id(tab))
+        if self.steal == "retrigger" and last is not None and self.tables[last] is tab:
+            return last
+        if self.steal == "quietest":
+            # linear decay estimate of each voice's remaining level
+            age = now - self.start
+            remaining = np.clip(1.0 - age / self.dur, 0.0, 1.0)
+            score = self.mul * remaining
+            # voices still taking coalesced triggers are not stolen
+            # (unless every voice is, then fall back to round robin)
+            score[age < self.coalesce] = np.inf
+            voice = int(np.argmin(score))
+            if np.isfinite(score[voice]):
+                return voice
+        voice = self.next
+        self.next = (self.next + 1) % self.n
+        return voice
 
     def play(self, tab, mul=1.0):
-        self.voices.sort()
-        dt, voice = self.voices[0]
+        """Trigger tab; returns the voice index used, or None
+        if the trigger was rate limited"""
+        now = self.clock()
+        key = id(tab)
+        last = self.last.get(key)
+        if (
+            last is not None
+            and self.tables[last] is tab
+            and now - self.start[last] < self.coalesce
+        ):
+            # fold into the voice triggered within this block
+            self.mul[last] = min(self.mul[last] + mul, self.max_mul)
+            self.players[last].mul = float(self.mul[last])
+            self.coalesced += 1
+            return last
+
+        if not self.allow(now):
+            self.limited += 1
+            return None
+
+        if key not in self.rates:
+            rate = tab.getRate()
+            self.rates[key] = (rate, 1.0 / rate)
+        rate, dur = self.rates[key]
+
+        i = self.allocate(tab, now)
+        voice = self.players[i]
         voice.stop()
         voice.mul = float(mul)
-        voice.freq = tab.getRate()
+        voice.freq = rate
         voice.reset()
         voice.setTable(tab)
         voice.play()
-        self.voices[0] = (datetime.now(), voice)
+        self.start[i] = now
+        self.mul[i] = mul
+        self.dur[i] = dur
+        self.tables[i] = tab
+        self.last[key] = i
+        self.triggered += 1
+        return i
+
+    def pyo_objects(self):
+        return self.players
+
+    def get_output(self):
+        return sum(self.players)
+
+
+class GrainCloud:
+    """Overlap-add grain engine for dense, event-driven clouds.
+
+    Grains are scheduled in numpy batches with schedule(), and mixed
+    with numpy, one chunk at a time, into a ring table that a Phasor
+    driven TableIndex plays back. update() mixes every grain up to
+    lookahead seconds ahead of the read head, so it must be called
+    more often than that (once per frame, or once per block offline).
+    The cost is a vectorised overlap-add per update, rather than
+    one pyo object per grain."""
+
+    def __init__(
+        self,
+        source,
+        server,
+        dur=0.05,
+        ring_time=1.0,
+        lookahead=0.05,
+        max_grains=4096,
+        chunk=4096,
+    ):
+        self.sr = int(server.getSamplingRate())
+        # mono copy of the source, with a guard sample for interpolation
+        self.source = np.append(np.asarray(source.getBuffer(), dtype=np.float32), 0)
+        self.delta = np.append(np.diff(self.source), np.float32(0))
+        self.grain_length = int(dur * self.sr)
+        self.n = int(ring_time * self.sr)
+        self.lookahead = int(lookahead * self.sr)
+        self.chunk = chunk
+        self.env = np.hanning(1025).astype(np.float32)
+
+        self.table = pyo.DataTable(size=self.n)
+        # zero-copy view of the table samples
+        self.ring = np.asarray(self.table.getBuffer())
+        self.phasor = pyo.Phasor(freq=self.table.getRate())
+        self.reader = pyo.TableIndex(self.table, self.phasor * self.n)
+
+        # pending grains, as preallocated columns
+        self.max_grains = max_grains
+        self.start = np.zeros(max_grains, dtype=np.int64)
+        self.length = np.zeros(max_grains, dtype=np.int64)
+        self.pos = np.zeros(max_grains, dtype=np.float64)
+        self.pitch = np.zeros(max_grains, dtype=np.float64)
+        self.amp = np.zeros(max_grains, dtype=np.float32)
+        self.count = 0
+
+        # absolute sample counts: read so far, and mixed so far
+        self.head = 0
+        self.last_index = 0
+        self.written = 0
+        self.scheduled = 0
+        self.dropped = 0
+        self.late = 0
+
+    def pyo_objects(self):
+        return [self.phasor, self.reader]
 
     def get_output(self):
-        return sum([voice for dt, voice in self.voices])
+        return self.reader
+
+    def read_head(self):
+        """Absolute number of samples played, to within one block"""
+        index = int(self.phasor.get() * self.n)
+        self.head += (index - self.last_index) % self.n
+        self.last_index = index
+        return self.head
+
+    def schedule(self, times, positions, pitches=1.0, amps=1.0, durs=None):
+        """Schedule a batch of grains. times are seconds after the
+        mixed horizon (so at least lookahead from now); positions
+        are fractions of the source; pitches are playback rates.
+        Scalars broadcast. Returns the number of grains accepted"""
+        times, positions, pitches, amps = np.broadcast_arrays(
+            times, positions, pitches, amps
+        )
+        n = min(len(times), self.max_grains - self.count)
+        self.dropped += len(times) - n
+        if n <= 0:
+            return 0
+        k = slice(self.count, self.count + n)
+        if durs is None:
+            length = self.grain_length
+        else:
+            length = (np.broadcast_to(durs, times.shape)[:n] * self.sr).astype(np.int64)
+        self.start[k] = self.written + (times[:n] * self.sr).astype(np.int64)
+        self.length[k] = np.maximum(length, 1)
+        # keep every grain inside the source
+        span = np.maximum(len(self.source) - 1 - self.length[k] * pitches[:n], 0)
+        self.pos[k] = np.clip(positions[:n], 0.0, 1.0) * span
+        self.pitch[k] = pitches[:n]
+        self.amp[k] = amps[:n]
+        self.count += n
+        self.scheduled += n
+        return n
+
+    def update(self):
+        """Mix all grains up to lookahead past the read head"""
+        head = self.read_head()
+        if self.written < head:
+            # called too late: the read head overtook the mix
+            self.late += 1
+            self.written = head
+        end = min(head + self.lookahead, head + self.n - self.chunk)
+        while self.written < end:
+            stop = min(self.written + self.chunk, end)
+            self.mix(self.written, stop)
+            self.written = stop
+
+    def mix(self, a, b):
+        """Overlap-add every grain overlapping samples [a, b)"""
+        k = self.count
+        start, length = self.start[:k], self.length[:k]
+        lo = np.maximum(start, a)
+        hi = np.minimum(start + length, b)
+        active = np.flatnonzero(hi > lo)
+        out = np.zeros(b - a, dtype=np.float32)
+        if len(active):
+            # one element per (grain, sample) actually inside a grain:
+            # per-grain values are computed once and expanded with repeat
+            lo, hi = lo[active], hi[active]
+            counts = hi - lo
+            first = np.cumsum(counts) - counts
+            local = np.arange(counts.sum(), dtype=np.float32)
+            local -= np.repeat(first.astype(np.float32), counts)
+            offset = (lo - start[active]).astype(np.float32)
+            pitch = self.pitch[active]
+            read = local * np.repeat(pitch.astype(np.float32), counts)
+            read += np.repeat(
+                (self.pos[active] + offset * pitch).astype(np.float32), counts
+            )
+            # (grains longer than the source just hold its last sample)
+            np.clip(read, 0, len(self.source) - 1, out=read)
+            i = read.astype(np.int32)
+            src = np.take(self.delta, i)
+            src *= read - i
+            src += np.take(self.source, i)
+            step = (len(self.env) - 1) / length[active].astype(np.float32)
+            e = local * np.repeat(step, counts)
+            e += np.repeat(offset * step, counts)
+            src *= np.take(self.env, e.astype(np.int32))
+            src *= np.repeat(self.amp[active], counts)
+            # scatter into a grains x samples grid and sum the columns
+            # (cheaper than a weighted bincount)
+            at = local.astype(np.int32)
+            at += np.repeat(
+                (np.arange(len(active)) * (b - a) + lo - a).astype(np.int32), counts
+            )
+            grid = np.zeros(len(active) * (b - a), dtype=np.float32)
+            grid[at] = src
+            out = grid.reshape(len(active), b - a).sum(axis=0)
+        # forget finished grains
+        finished = start + length <= b
+        if finished.any():
+            keep = np.flatnonzero(~finished)
+            for column in (self.start, self.length, self.pos, self.pitch, self.amp):
+                column[: len(keep)] = column[keep]
+            self.count = len(keep)
+        self.ring[np.arange(a, b) % self.n] = out
+
+    def stats(self):
+        return {
+            "pending": self.count,
+            "scheduled": self.scheduled,
+            "dropped": self.dropped,
+            "late": self.late,
+        }
+
+
+class AudioAnalysis:
+    """Spectrum and level analysis of a signal, for the visuals.
+
+    An FFT writes bin magnitudes into a table, and Follower/PeakAmp
+    track the level. callback() (run from the server's block callback,
+    in the audio thread) copies them into the back half of a
+    preallocated double buffer and flips it; read() copies out the
+    front half. Neither side takes a lock or allocates arrays.
+
+    Each buffer holds n_bins log-compressed magnitudes, then the
+    rms and peak levels"""
+
+    def __init__(self, size=512, smooth_hz=20.0, gain=100.0):
+        self.n_bins = size // 2
+        self.input = pyo.InputFader(pyo.Sig(0.0))
+        self.mono = pyo.Mix(self.input, voices=1)
+        self.fft = pyo.FFT(self.mono, size=size, overlaps=1)
+        real, imag = self.fft["real"], self.fft["imag"]
+        self.magnitude = pyo.Sqrt(real * real + imag * imag)
+        self.table = pyo.DataTable(size=size)
+        self.writer = pyo.TableWrite(
+            self.magnitude, pos=self.fft["bin"], table=self.table, mode=1
+        )
+        self.rms = pyo.Follower(self.mono, freq=smooth_hz)
+        self.peak = pyo.PeakAmp(self.mono)
+        # zero-copy view of the positive-frequency bins
+        self.spectrum = np.asarray(self.table.getBuffer())[: self.n_bins]
+        self.scale = gain
+        self.buffers = np.zeros((2, self.n_bins + 2), dtype=np.float32)
+        # the reader's copy
+        self.out = np.zeros(self.n_bins + 2, dtype=np.float32)
+        self.front = 0
+        self.seq = 0
+
+    def set_input(self, sig, fade_time=0.05):
+        """Crossfade the analysis to a new signal"""
+        self.input.setInput(sig, fade_time)
+
+    def callback(self):
+        back = self.buffers[1 - self.front]
+        bins = back[: self.n_bins]
+        np.multiply(self.spectrum, self.scale, out=bins)
+        np.log1p(bins, out=bins)
+        back[-2] = self.rms.get()
+        back[-1] = self.peak.get()
+        # publish: the reader only ever sees a complete buffer
+        self.front = 1 - self.front
+        self.seq += 1
+
+    def read(self):
+        """Return (sequence number, latest analysis buffer). The
+        buffer is a copy, valid until the next read(): the front
+        half itself is rewritten as soon as the next block has
+        flipped, so the copy is retried if a flip happened during it"""
+        while True:
+            seq = self.seq
+            np.copyto(self.out, self.buffers[self.front])
+            if self.seq == seq:
+                return seq, self.out
+
+
+def bench_grains(rates, seconds=5.0, dur=0.05):
+    """Grain throughput against DSP cost on a manual server: for
+    each rate (grains/s), schedule one batch per block, then mix
+    and compute the block"""
+    server = pyo.Server(audio="manual").boot()
+    server.start()
+    source = pyo.SndTable("sounds/pulse.wav")
+    sr = server.getSamplingRate()
+    block = server.getBufferSize() / sr
+    rng = np.random.default_rng(0)
+    results = []
+    for rate in rates:
+        cloud = GrainCloud(source, server, dur=dur, max_grains=16384)
+        out = cloud.get_output().out()
+        n_blocks = int(seconds / block)
+        per_block = rate * block
+        cost = 0.0
+        for b in range(n_blocks):
+            t = perf_counter()
+            n = rng.poisson(per_block)
+            cloud.schedule(
+                rng.uniform(0, block, n),
+                rng.uniform(0, 1, n),
+                2.0 ** rng.normal(0, 0.3, n),
+                0.05,
+            )
+            cloud.update()
+            server.process()
+            cost += perf_counter() - t
+        out.stop()
+        results.append((rate, cloud.scheduled / seconds, cost / (n_blocks * block)))
+    server.stop()
+    return results
+
+
+if __name__ == "__main__":
+    # microbenchmark: trigger cost per voice stealing policy, on a
+    # manual server processing blocks in between bursts of triggers.
+    # The blocks run faster than realtime, so the voices run on audio
+    # time (blocks computed), and coalescing folds exactly the
+    # triggers landing in the same block; the cost is CPU time
+    import argparse
+
+    parser = argparse.ArgumentParser(description="SampleVoices/GrainCloud benchmarks")
+    parser.add_argument(
+        "mode", nargs="?", default="voices", choices=["voices", "grains"]
+    )
+    parser.add_argument("--n", type=int, default=20000, help="Triggers per policy")
+    parser.add_argument("--voices", type=int, default=32)
+    parser.add_argument("--per_block", type=int, default=20, help="Triggers per block")
+    parser.add_argument(
+        "--rates",
+        default="1000,5000,20000,50000",
+        help="Grain rates (grains/s) to benchmark",
+    )
+    args = parser.parse_args()
+
+    if args.mode == "grains":
+        rates = [int(r) for r in args.rates.split(",")]
+        for rate, achieved, load in bench_grains(rates):
+            print(
+                f"{rate:>7} grains/s requested: {achieved:9.0f} grains/s mixed, "
+                f"load {load*100:6.2f}% ({1/load if load else 0:.1f}x realtime)"
+            )
+        exit()
+
+    server = pyo.Server(audio="manual").boot()
+    server.start()
+    tabs = [pyo.SndTable("sounds/ping.wav"), pyo.SndTable("sounds/pulse.wav")]
+    block = server.getBufferSize() / server.getSamplingRate()
+    blocks = 0
+
+    def audio_time():
+        return blocks * block
+
+    for steal in ("oldest", "quietest", "retrigger"):
+        # 0, or fold only the triggers landing in the same block
+        for coalesce in (0.0, 0.5 * block):
+            voices = SampleVoices(
+                args.voices, steal=steal, coalesce=coalesce, clock=audio_time
+            )
+            out = voices.get_output().out()
+            trigger_time = 0.0
+            for i in range(args.n // args.per_block):
+                t = perf_counter()
+                for j in range(args.per_block):
+                    voices.play(tabs[j % 2], mul=0.5)
+                trigger_time += perf_counter() - t
+                server.process()
+                blocks += 1
+            out.stop()
+            print(
+                f"{steal:>9} coalesce={coalesce*1000:.1f}ms: "
+                f"{trigger_time/args.n*1e6:6.2f} us/trigger, "
+                f"{args.n/trigger_time:9.0f} triggers/s of CPU "
+                f"({voices.triggered} played, {voices.coalesced} coalesced)"
+            )
+    server.stop()
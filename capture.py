@@ -0,0 +1,262 @@
+import json
+import queue
+import subprocess
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+import numpy as np
+
+# Asynchronous frame capture. Each frame's texture is packed into one
+# of a ring of pixel buffers (a GPU-side copy that returns at once),
+# and only read back to the host `latency` frames later, when the GPU
+# has long finished writing it. moderngl exposes no fences, so frame
+# age stands in for one. Host copies go to a thread pool that writes
+# PNGs, raw frames or an ffmpeg pipe. The pool of host arrays is
+# fixed: when the writers fall behind, frames are dropped rather than
+# slowing the render loop.
+
+formats = ("png", "raw", "ffmpeg")
+
+
+def git_stamp(git):
+    """One-line git stamp, as the on-screen overlay shows it"""
+    dirty = "UNCOMMITTED " if git.get("dirty") else ""
+    return (
+        f"{dirty}{git.get('branch', '')} {git['sha']} "
+        f"{git.get('author', '')} {git.get('date', '')}"
+    )
+
+
+class FrameCapture:
+    """Capture a texture to path every time capture() is called.
+    format "png" and "raw" write numbered frames into the directory
+    path (raw frames with a capture.json describing them); "ffmpeg"
+    pipes raw frames to an ffmpeg process encoding the video file path.
+    git (from version.get_git_info()) is stamped into every frame"""
+
+    def __init__(
+        self,
+        ctx,
+        size,
+        path="capture",
+        format="png",
+        components=3,
+        latency=2,
+        max_pending=8,
+        workers=2,
+        fps=60,
+        git=None,
+    ):
+        if format not in formats:
+            raise ValueError(
+                f"Unknown capture format {format}, expected one of {formats}"
+            )
+        self.ctx = ctx
+        self.size = size
+        self.path = Path(path)
+        self.format = format
+        self.components = components
+        self.latency = latency
+        self.git = git
+        self.stamp = git_stamp(git) if git else ""
+        w, h = size
+        self.shape = (h, w, components)
+        nbytes = w * h * components
+        self.buffers = [ctx.buffer(reserve=nbytes) for i in range(latency + 1)]
+        # frame number packed into each buffer, or None
+        self.pending = [None] * len(self.buffers)
+        self.free = queue.SimpleQueue()
+        for i in range(max_pending):
+            self.free.put(np.empty(self.shape, dtype=np.uint8))
+        self.frame = 0
+        self.captured = self.dropped = self.written = self.failed = 0
+        self.ffmpeg = None
+        if format == "ffmpeg":
+            # frames must reach the pipe in order
+            workers = 1
+            self.path.parent.mkdir(parents=True, exist_ok=True)
+            self.ffmpeg = subprocess.Popen(
+                self.ffmpeg_command(fps), stdin=subprocess.PIPE
+            )
+        else:
+            self.path.mkdir(parents=True, exist_ok=True)
+        self.pool = ThreadPoolExecutor(workers, thread_name_prefix="capture")
+
+    def ffmpeg_command(self, fps):
+        w, h = self.size
+        pix_fmt = {3: "rgb24", 4: "rgba"}[self.components]
+        return [
+            "ffmpeg",
+            "-y",
+            "-loglevel",
+            "error",
+            "-f",
+            "rawvideo",
+            "-pix_fmt",
+            pix_fmt,
+            "-s",
+            f"{w}x{h}",
+            "-r",
+            str(fps),
+            "-i",
+            "-",
+            # GL rows run bottom to top
+            "-vf",
+            "vflip",
+            "-pix_fmt",
+            "yuv420p",
+            "-metadata",
+            f"comment={self.stamp}",
+            str(self.path),
+        ]
+
+    def capture(self, texture):
+        """Queue this frame of texture; collects the frame packed
+        `latency` frames ago into the writers"""
+        slot = self.frame % len(self.buffers)
+        if self.pending[slot] is not None:
+            self._collect(slot)
+        texture.read_into(self.buffers[slot], alignment=1)
+        self.pending[slot] = self.frame
+        self.frame += 1
+
+    def _collect(self, slot):
+        frame = self.pending[slot]
+        self.pending[slot] = None
+        self.captured += 1
+        try:
+            array = self.free.get_nowait()
+        except queue.Empty:
+            # writers are behind: drop, never wait
+            self.dropped += 1
+            return
+        self.buffers[slot].read_into(array)
+        self.pool.submit(self._write, frame, array)
+
+    def _write(self, frame, array):
+        try:
+            if self.format == "png":
+                # Pillow is only needed for png capture
+                from PIL import Image
+                from PIL.PngImagePlugin import PngInfo
+
+                info = PngInfo()
+                info.add_text("Comment", self.stamp)
+                info.add_text("Frame", str(frame))
+                mode = "RGB" if self.components == 3 else "RGBA"
+                image = Image.fromarray(array[::-1], mode)
+                # compress_level 1: fast, the writers are the bottleneck
+                image.save(
+                    self.path / f"{frame:06d}.png", pnginfo=info, compress_level=1
+                )
+            elif self.format == "raw":
+                array.tofile(self.path / f"{frame:06d}.raw")
+            else:
+                self.ffmpeg.stdin.write(array.data)
+            self.written += 1
+        except Exception as e:
+            # futures are never checked, so count (and report once) here
+            if not self.failed:
+                print(f"Capture: writing frame {frame} failed: {e}", file=sys.stderr)
+            self.failed += 1
+        finally:
+            self.free.put(array)
+
+    def stats(self):
+        return {
+            "frames": self.frame,
+            "captured": self.captured,
+            "written": self.written,
+            "dropped": self.dropped,
+            "failed": self.failed,
+        }
+
+    def close(self):
+        """Collect the frames still in flight, wait for the writers
+        and finish the output"""
+        for i in range(len(self.buffers)):
+            # oldest first, so frames stay in order
+            slot = (self.frame + i) % len(self.buffers)
+            if self.pending[slot] is not None:
+                self._collect(slot)
+        self.pool.shutdown(wait=True)
+        if self.ffmpeg is not None:
+            self.ffmpeg.stdin.close()
+            self.ffmpeg.wait()
+        elif self.format == "raw":
+            w, h = self.size
+            with open(self.path / "capture.json", "w") as f:
+                json.dump(
+                    {
+                        "width": w,
+                        "height": h,
+                        "components": self.components,
+                        "dtype": "uint8",
+                        "rows": "bottom to top",
+                        "git": self.git,
+                        **self.stats(),
+                    },
+                    f,
+                    indent=2,
+                )
+        for buf in self.buffers:
+            buf.release()
+        return self.stats()
+
+
+def bench_capture(ctx, size=(1024, 1024), frames=120, **kwargs):
+    """Frame time of capture() (FrameCapture with kwargs) against a
+    synchronous texture.read() each frame, on a changing texture"""
+    texture = ctx.texture(size, 3)
+    fbo = ctx.framebuffer(texture)
+    fbo.use()
+    results = {}
+    t = time.perf_counter()
+    for i in range(frames):
+        fbo.clear(i / frames, 0.5, 0.0)
+        texture.read()
+    results["sync"] = (time.perf_counter() - t) / frames * 1000.0
+
+    capture = FrameCapture(ctx, size, **kwargs)
+    t = time.perf_counter()
+    for i in range(frames):
+        fbo.clear(i / frames, 0.5, 0.0)
+        capture.capture(texture)
+    results["async"] = (time.perf_counter() - t) / frames * 1000.0
+    results.update(capture.close())
+    fbo.release()
+    texture.release()
+    return results
+
+
+if __name__ == "__main__":
+    import argparse
+    import moderngl
+    import version
+
+    parser = argparse.ArgumentParser(description="Frame capture benchmark")
+    parser.add_argument("--format", default="raw", choices=formats)
+    parser.add_argument("--path", default="capture")
+    parser.add_argument("--frames", type=int, default=120)
+    parser.add_argument("--size", type=int, default=1024)
+    parser.add_argument("--backend", default="egl", help="moderngl context backend")
+    args = parser.parse_args()
+
+    ctx = moderngl.create_standalone_context(backend=args.backend)
+    git = version.get_git_info()
+    results = bench_capture(
+        ctx,
+        (args.size, args.size),
+        args.frames,
+        path=args.path,
+        format=args.format,
+        git=git,
+    )
+    print(git_stamp(git))
+    print(
+        f"sync read {results['sync']:.2f}ms/frame, "
+        f"async capture {results['async']:.2f}ms/frame; "
+        f"{results['written']} written, {results['dropped']} dropped, "
+        f"{results['failed']} failed"
+    )
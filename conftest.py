@@ -0,0 +1,2 @@
+# pyo_test.py is a manual audio check that boots a pyo server on import
+collect_ignore = ["pyo_test.py"]
@@ -0,0 +1,207 @@
+import json
+import pickle
+import struct
+import time
+import numpy as np
+
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# Decoders turn a raw ZMQ payload (bytes or memoryview) into a value.
+# Fixed-layout decoders also expose a numpy dtype, which lets the
+# relay stack a whole frame of packets into one array.
+
+
+class Decoder:
+    """Pass payloads through unchanged, as bytes"""
+
+    dtype = None
+
+    def decode(self, payload):
+        return bytes(payload)
+
+
+class JsonDecoder(Decoder):
+    def decode(self, payload):
+        return json.loads(bytes(payload))
+
+
+class MsgpackDecoder(Decoder):
+    def __init__(self):
+        if msgpack is None:
+            raise ImportError("MsgpackDecoder requires the msgpack package")
+
+    def decode(self, payload):
+        return msgpack.unpackb(payload)
+
+
+class StructDecoder(Decoder):
+    """Decode a fixed-layout packet with a struct format
+    string, returning a dict of the named fields"""
+
+    def __init__(self, fmt, fields):
+        self.fmt = fmt
+        self.fields = fields
+        self.struct = struct.Struct(fmt)
+        # the same layout as a numpy record, so packets can be stacked
+        self.dtype = np.dtype([(f, "<" + c) for f, c in zip(fields, struct_codes(fmt))])
+        if self.dtype.itemsize != self.struct.size:
+            raise ValueError(f"Struct format {fmt} must be packed little-endian")
+
+    def __getstate__(self):
+        return {"fmt": self.fmt, "fields": self.fields}
+
+    def __setstate__(self, state):
+        self.__init__(state["fmt"], state["fields"])
+
+    def decode(self, payload):
+        return dict(zip(self.fields, self.struct.unpack(payload)))
+
+
+class RecordDecoder(Decoder):
+    """Decode packets as numpy records of the given dtype,
+    as a zero-copy view onto the payload"""
+
+    def __init__(self, dtype):
+        self.dtype = np.dtype(dtype)
+
+    def decode(self, payload):
+        return np.frombuffer(payload, self.dtype)
+
+
+def struct_codes(fmt):
+    """Expand a struct format ("<3fI") into one type code per field"""
+    codes = []
+    count = ""
+    for c in fmt.lstrip("<"):
+        if c.isdigit():
+            count += c
+        else:
+            codes.extend([c] * int(count or 1))
+            count = ""
+    return codes
+
+
+decoders = {
+    "raw": Decoder,
+    "json": JsonDecoder,
+    "msgpack": MsgpackDecoder,
+}
+
+# packet count prefix for conflated packets
+_count = struct.Struct("<Q")
+
+coalesce_modes = (None, "latest", "stack", "conflate")
+
+
+def as_mapping(value):
+    """Turn a decoded value into a {key: value} dict
+    for latest-value coalescing"""
+    if isinstance(value, dict):
+        return value
+    if isinstance(value, np.ndarray) and value.dtype.names:
+        return {name: value[name][-1].item() for name in value.dtype.names}
+    return {"value": value}
+
+
+class Coalescer:
+    """Merge decoded packets inside the relay worker, so the host
+    gets one item per frame instead of one per packet.
+
+    mode="latest" keeps the latest value for each key (dict packets,
+    or the fields of records); mode="stack" concatenates fixed-layout
+    packets into one array; mode="conflate" just keeps the latest
+    raw packet. The merged batch is written to the ring when the
+    host has taken the previous one, or after flush_ms, so that the
+    batch waiting in the ring is never more than flush_ms stale.
+    A "latest" batch too large for one ring slot is split across
+    several."""
+
+    def __init__(self, decoder, mode="latest", flush_ms=5.0):
+        if mode not in coalesce_modes[1:]:
+            raise ValueError(f"Unknown coalesce mode {mode}")
+        if mode == "stack" and decoder.dtype is None:
+            raise ValueError("Stacking needs a fixed-layout (struct/record) decoder")
+        self.decoder = decoder
+        self.mode = mode
+        self.flush_ms = flush_ms
+        self.last_write = 0.0
+        self.reset()
+
+    def reset(self):
+        self.count = 0
+        self.state = {}
+        self.chunks = []
+        self.size = 0
+        self.latest = None
+
+    def add(self, payload, ring):
+        if self.mode == "latest":
+            self.state.update(as_mapping(self.decoder.decode(payload)))
+        elif self.mode == "conflate":
+            self.latest = bytes(payload)
+        else:
+            if len(payload) % self.decoder.dtype.itemsize:
+                raise ValueError(
+                    f"{len(payload)} byte packet is not a whole number of records"
+                )
+            if len(payload) > ring.slot_size:
+                raise ValueError(
+                    f"{len(payload)} byte packet is larger than a ring slot"
+                )
+            if self.chunks and self.size + len(payload) > ring.slot_size:
+                # batch would not fit into one slot
+                self.write(ring)
+            self.chunks.append(bytes(payload))
+            self.size += len(payload)
+        self.count += 1
+
+    def write(self, ring):
+        if self.mode == "latest":
+            self._put_state(ring, self.count, list(self.state.items()))
+        elif self.mode == "conflate":
+            ring.put(_count.pack(self.count) + self.latest)
+        else:
+            ring.put(b"".join(self.chunks))
+        self.last_write = time.perf_counter()
+        self.reset()
+
+    def _put_state(self, ring, count, items):
+        data = pickle.dumps((count, dict(items)), pickle.HIGHEST_PROTOCOL)
+        if len(data) > ring.slot_size and len(items) > 1:
+            # split the batch across slots; unpack() merges them again
+            half = len(items) // 2
+            self._put_state(ring, count, items[:half])
+            self._put_state(ring, 0, items[half:])
+        else:
+            ring.put(data)
+
+    def flush(self, ring):
+        """Write the pending batch once the host has drained
+        the ring, or the last batch is older than flush_ms"""
+        if not self.count:
+            return
+        age = time.perf_counter() - self.last_write
+        if len(ring) == 0 or age * 1000.0 > self.flush_ms:
+            self.write(ring)
+
+    def unpack(self, views):
+        """Merge drained batches on the host side into a single
+        (count, value) pair, or None if nothing arrived"""
+        if not views:
+            return None
+        if self.mode == "latest":
+            count, state = 0, {}
+            for view in views:
+                n, batch = pickle.loads(view)
+                count += n
+                state.update(batch)
+            return count, state
+        if self.mode == "conflate":
+            count = sum(_count.unpack_from(view)[0] for view in views)
+            return count, self.decoder.decode(views[-1][_count.size :])
+        arrays = [np.frombuffer(view, self.decoder.dtype) for view in views]
+        value = arrays[0] if len(arrays) == 1 else np.concatenate(arrays)
+        return len(value), value
@@ -1,42 +1,35 @@
-from timing import iso_now, accurate_time
 import time
-from pathlib import Path
 import version
 import imgui
 import moderngl
-import numpy as np
 from moderngl_window import geometry
-from moderngl_window.opengl.vao import VAO
 from moderngl_window.scene import Camera
 from pyrr import Matrix44
 from window import WindowEvents, iso_now
-from audio_fbk import (
-    AudioFbk,
-    WindFbk,
-)
-from shader_ui import ShaderCheckbox, ShaderSlider
+from audio_fbk import feedbacks
+from shader_ui import ShaderCheckbox, ShaderSlider, ComboList
+from monitor import Monitor
+from particles import Particles, LOCAL_SIZE, render_paths
+from resolution import AdaptiveResolution, FramebufferPool, quantize
 
 
-class WindowEvents(mglw.WindowConfig):
-    gl_version = (4, 3)
+class DemoEvents(WindowEvents):
     title = version.demo_name
-    resource_dir = (Path(__file__).parent).resolve()
-    aspect_ratio = None
 
     # map shader name to path to glsl file
     shader_paths = {
         "quad": "shaders/quad.glsl",
         "particles": "shaders/particle.glsl",
+        "particles_instanced": "shaders/particle_instanced.glsl",
         "tex_quad": "shaders/tex_quad.glsl",
     }
 
     compute_shader_paths = {"particle_dynamics": "shaders/dynamics.glsl"}
+    # #define values substituted into compute shaders
+    compute_shader_defines = {"particle_dynamics": {"LOCAL_SIZE": LOCAL_SIZE}}
 
     # audio "shaders"
-    audio_feedback_map = {
-        "None": AudioFbk,
-        "Wind": WindFbk,
-    }
+    audio_feedback_map = feedbacks
 
     fonts = {"fira-16": ("fonts/FiraMono-Regular.ttf", 16)}
 
@@ -44,6 +37,38 @@ class WindowEvents(mglw.WindowConfig):
     @classmethod
     def add_arguments(cls, parser):
         super(DemoEvents, cls).add_arguments(parser)
+        parser.add_argument(
+            "--particles",
+            type=int,
+            default=64 * 128,
+            help="Number of particles",
+        )
+        parser.add_argument(
+            "--particle_render",
+            default="geometry",
+            choices=list(render_paths),
+            help="Draw particles with a geometry shader or instanced quads",
+        )
+        parser.add_argument(
+            "--render_size",
+            type=int,
+            default=None,
+            help="Full-scale render size (default: the window's smaller side)",
+        )
+        parser.add_argument(
+            "--frame_budget",
+            type=float,
+            default=1000.0 / 60.0,
+            help="Target frame time in ms for adaptive render resolution",
+        )
+        parser.add_argument(
+            "--adaptive_resolution",
+            type=int,
+            default=1,
+            choices=[0, 1],
+            help="Scale the render resolution to keep within --frame_budget "
+            "(always off while capturing)",
+        )
         parser.add_argument(
             "--x",
             "-x",
@@ -53,100 +78,29 @@ class WindowEvents(mglw.WindowConfig):
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
-
+        self.monitor = Monitor()
+        self.monitor.clear_flag("ZMQ")
         self.ui_font = self.loaded_fonts["fira-16"]
         self.init_gl()
         self.load_shaders()
+        self.shader_manager.on_swap.append(self.forget_program)
         self.init_gui_elements()
-        self.alive = False
+        self.load_preset()
+        self.last_audio_watch = 0.0
+        # published frames between computing particle positions and
+        # sending them
+        self.publish_latency = 2
+
+    def init_git(self):
+        self.git = version.get_git_info()
 
     def create_particles(self):
-        # create the VAO for particle vertices
-        self.particles = VAO(name="test", mode=moderngl.POINTS)
-        self.positions = np.random.uniform(-1, 1, (64 * 128, 4)).astype(np.float32)
-        self.positions[:, 2] = 0.0
-        # numpy -> GPU
-        self.particle_buf = self.particles.buffer(self.positions, "4f", ["in_position"])
+        # ping-pong particle buffers, numpy -> GPU
+        self.particles = Particles(self.ctx, int(self.argv.particles))
 
     def get_projection(self):
         return self.camera.projection.matrix  # proj
 
-    def close(self):
-        self.relay.close()
-        time.sleep(0.1)
-        self.audio_server.close()
-        time.sleep(0.1)
-        exit()
-
-    def load_shaders(self):
-        # load all of the shaders into a dictionary
-        self.shaders = {}
-        for shader, path in self.shader_paths.items():
-            print(path)
-            self.shaders[shader] = self.load_program(path)
-
-        for shader, path in self.compute_shader_paths.items():
-            self.shaders[shader] = self.load_compute_shader(path)
-
-    def set_feedback(self, fbk):
-        """Set the feedback type to the given value"""
-        if self.audio is not None:
-            del self.audio
-        self.audio_server.stop()
-        time.sleep(0.05)
-        self.audio_server.start()
-        self.audio = fbk(self.audio_server)
-
-    @classmethod
-    def add_arguments(self, parser):
-        # we can add any arguments to the cmd line here
-        # ZMQ port
-        parser.add_argument(
-            "--port",
-            "-p",
-            default=5556,
-            help="Set the port to listen on for incoming ZMQ messages",
-        )
-        parser.add_argument(
-            "--audio",
-            "-a",
-            default="Wind",
-            help="Set the initial audio feedback used on startup",
-        )
-
-        parser.add_argument(
-            "--device",
-            "-d",
-            default=-1,
-            help="Set the PortAudio device number used for audio feedback",
-        )
-        parser.add_argument(
-            "--audio_server",
-            default="pa",
-            help="Set the server to use (portaudio, jack or coreaudio)",
-        )
-
-    def init_gui(self):
-        # construct the window image
-        imgui.create_context()
-
-        # initialise window and audio
-        self.imgui = ModernglWindowRenderer(self.wnd)
-
-    def init_audio(self):
-        self.audio_server = AudioServer(
-            audio=True, device=int(self.argv.device), server=self.argv.audio_server
-        )
-        self.audio_feedbacks = ComboList(
-            {
-                "None": AudioFbk,
-                "Wind": WindFbk,
-            }
-        )
-        self.audio = None
-        # use command line arg for initial connection
-        self.set_feedback(self.audio_feedbacks.dict[self.argv.audio])
-
     def init_gl(self):
         # create camera
         self.camera = Camera(
@@ -155,102 +109,185 @@ class WindowEvents(mglw.WindowConfig):
         # self.camera.set_position(0.0, 0.0, 0.0)
         # self.camera.set_rotation(self.camera.yaw, 0.0)
 
-        # create the FBO, geometry and load shaders
-        self.fbo_texture = self.ctx.texture((1024, 1024), 3)
-        depth = self.ctx.depth_renderbuffer((1024, 1024))
-        self.fbo = self.wnd.ctx.framebuffer(self.fbo_texture, depth)
+        # create the FBO (sized by the frame time, from a pool of
+        # framebuffers), geometry and load shaders
+        self.fbo_pool = FramebufferPool(self.ctx)
+        self.resolution = AdaptiveResolution(
+            self.render_base(),
+            budget_ms=self.argv.frame_budget,
+            # captured frames must all be the same size, and benchmark
+            # timings must all be measured at one
+            enabled=bool(self.argv.adaptive_resolution)
+            and not (self.argv.capture or self.argv.bench_frames),
+        )
+        self.set_render_size(self.resolution.size())
         self.fbo_quad = geometry.quad_2d(size=(0.5, 1), uvs=True)
         self.quad = geometry.quad_2d(size=(2, 2), uvs=True)
         self.deflector_quad = geometry.quad_2d(size=(0.5, 0.5), uvs=True)
         self.create_particles()
+        self.init_capture(self.fbo_texture)
+        self.model = Matrix44.from_translation((0.0, 0.0, -1.0), dtype="f4")
+        self.frame_data.set_camera(self.camera)
+
+    def render_base(self):
+        """Full-scale (square) render size"""
+        if self.argv.render_size:
+            side = self.argv.render_size
+        else:
+            side = quantize(min(self.wnd.buffer_size))
+        return (side, side)
+
+    def set_render_size(self, size):
+        """Render into the pooled framebuffer of this size from now on"""
+        self.fbo, self.fbo_texture = self.fbo_pool.get(size)
+        self.frame_data.set_resolution(size)
+
+    def bind_program(self, program):
+        super().bind_program(program)
+        if "m_model" in program:
+            program["m_model"].write(self.model)
+
+    def render_info(self):
+        w, h = self.fbo_texture.size
+        return {"render_size": [w, h], "render_scale": self.resolution.scale()}
+
+    def forget_program(self, old, new):
+        """Release the vertex arrays built for a replaced program"""
+        self.particles.forget(old)
+        for vao in (self.quad, self.fbo_quad, self.deflector_quad):
+            instance = vao.vaos.pop(old.glo, None)
+            if instance is not None:
+                instance.release()
 
     def init_gui_elements(self):
+        # particle render path, switchable at runtime
+        self.ui_particle_render = ComboList(
+            {path: path for path in render_paths}, self.argv.particle_render
+        )
         # UI flags -- these directly set shader
         # uniforms to update values
-        self.ui_show_particles = ShaderCheckbox(
-            self.shaders["particles"], "show_particles", init_state=True
+        self.ui_show_particles = self.params.add(
+            ShaderCheckbox(self.shaders["particles"], "show_particles", init_state=True)
         )
-        self.ui_speed = ShaderSlider(
-            self.shaders["particle_dynamics"], "speed", min=0.01, max=4.0, init=1.0
+        self.ui_speed = self.params.add(
+            ShaderSlider(
+                self.shaders["particle_dynamics"],
+                "speed",
+                min=0.01,
+                max=4.0,
+                init=1.0,
+                smooth=0.1,
+            )
         )
 
-    def init_zmq(self):
-        self.relay = Relay()
-
-    def init_git(self):
-        self.git = version.get_git_info()
-
-    def init_fonts(self):
-        io = imgui.get_io()
-        self.ui_font = io.fonts.add_font_from_file_ttf("fonts/FiraMono-Regular.ttf", 16)
-        self.imgui.refresh_font_texture()
-
-    def __init__(self, **kwargs):
-        super().__init__(**kwargs)
-        self.monitor = Monitor()
-        self.monitor.clear_flag("ZMQ")
-        self.init_git()
-        self.init_audio()
-        self.init_gui()
-        self.init_gl()
-        self.init_fonts()
-        self.init_gui_elements()
-        self.init_zmq()
-        self.init_t = accurate_time()
-        self.alive = False
-
     def render(self, time: float, frametime: float):
         self.monitor.watch("time", time)
         self.monitor.set_fps(1.0 / (frametime + 1e-6))
         self.monitor.update()
 
-        msg = self.relay.poll()
-        while msg:
-            self.audio.ping()
-            msg = self.relay.poll()
-
-        translation = Matrix44.from_translation((0.0, 0.0, -1.0), dtype="f4")
-        model = translation
-        t = accurate_time() - self.init_t
-
-        # copy time into every shader
-        for shader in self.shaders.values():
-            if "iTime" in shader:
-                shader["iTime"] = t
+        # drain the relay and copy time into every shader
+        self.update(time, frametime)
+        self.watch_audio()
 
+        profile = self.profiler.section
         # create an FBO to render to
         self.fbo.use()
         # render the background quad
-        self.ctx.enable_only(moderngl.BLEND)
-        self.quad.render(program=self.shaders["quad"])
-        self.ctx.blend_func = self.ctx.DEFAULT_BLENDING
+        with profile("quad"):
+            self.ctx.enable_only(moderngl.BLEND)
+            self.quad.render(program=self.shaders["quad"])
+            self.ctx.blend_func = self.ctx.DEFAULT_BLENDING
 
         # # render the particles and update them
-        self.ctx.enable_only(moderngl.BLEND)
-
-        self.particles.render(program=self.shaders["particles"])
-        self.particle_buf.bind_to_storage_buffer()
-        self.shaders["particle_dynamics"].run(64, 1, 1)
+        with profile("draw"):
+            self.ctx.enable_only(moderngl.BLEND)
+            path = self.ui_particle_render.option()
+            program = "particles_instanced" if path == "instanced" else "particles"
+            self.particles.draw(self.shaders[program], path)
+        with profile("compute"):
+            self.particles.step(self.shaders["particle_dynamics"])
+
+        if self.capture is not None:
+            with profile("capture"):
+                self.capture.capture(self.fbo_texture)
 
         # render the FBO
-        self.ctx.screen.use()
-        self.fbo_texture.use()
-
-        quad_prog = self.shaders["tex_quad"]
-        quad_prog["m_proj"].write(self.camera.projection.matrix)
-        quad_prog["m_camera"].write(self.camera.matrix)
-        quad_prog["m_model"].write(model)
-        self.fbo_quad.render(program=quad_prog)
-        self.render_ui()
-
-    def render_quad_into_window(self, texture, aspect=1):
+        with profile("blit"):
+            # the window's framebuffer (an offscreen one when headless)
+            self.wnd.use()
+            self.fbo_texture.use()
+
+            # camera and projection come from FrameData
+            self.fbo_quad.render(program=self.shaders["tex_quad"])
+        with profile("ui"):
+            self.render_ui()
+        with profile("publish"):
+            self.publish_state()
+        self.profiler.end_frame()
+        size = self.resolution.update(self.profiler.frame_time())
+        if size is not None:
+            self.set_render_size(size)
+        self.bench_frame()
+
+    def watch_audio(self):
+        """Show audio timing, pyo object counts and the render pass
+        timings in the monitor, at most once a second"""
+        now = time.perf_counter()
+        if now - self.last_audio_watch < 1.0:
+            return
+        self.last_audio_watch = now
+        self.profiler.export(self.monitor)
+        w, h = self.fbo_texture.size
+        self.monitor.watch(
+            "render size", f"{w}x{h} ({self.resolution.scale() * 100:.0f}%)"
+        )
+        stats = self.audio_server.stats()
+        self.monitor.watch("pyo streams", stats["streams"])
+        if "load" in stats:
+            self.monitor.watch("audio load", f"{stats['load'] * 100:.1f}%")
+            self.monitor.watch(
+                "audio block",
+                f"{stats['dsp_us']:.0f}/{stats['block_us']:.0f}us "
+                f"(p99 period {stats['period_p99_us']:.0f}us)",
+            )
+            self.monitor.watch("underruns", stats["underruns"])
+        if self.capture is not None:
+            captured = self.capture.stats()
+            self.monitor.watch(
+                "capture",
+                f"{captured['written']}/{captured['frames']} "
+                f"({captured['dropped']} dropped, {captured['failed']} failed)",
+            )
+        for name, (total, playing) in self.feedback_bank.objects().items():
+            self.monitor.watch(f"pyo {name}", f"{playing}/{total}")
+
+    def publish_state(self):
+        """Send particle positions and audio state downstream"""
+        if self.publisher is None:
+            return
+        # positions are read back a few published frames late, from a
+        # GPU-side copy, so the render loop never waits for the compute
+        # pass; frames decimated away are never copied
+        if self.publisher.due("particles"):
+            self.particles.stage(self.publish_latency)
+        positions = self.publisher.acquire("particles", self.particles.shape)
+        if positions is not None and self.particles.read_staged(positions):
+            lag = self.publish_latency * self.publisher.decimate
+            self.publisher.publish("particles", positions, lag=lag)
+        state = self.publisher.acquire("audio_state", self.audio.state.shape)
+        if state is not None:
+            state[:] = self.audio.state
+            self.publisher.publish("audio_state", state)
+
+    def render_quad_into_window(self, texture, aspect=None):
+        """Show texture (at whatever resolution it currently has)
+        filling the current imgui window"""
+        if aspect is None:
+            aspect = texture.width / texture.height
         # NB: fix aspect computation
         x, y = imgui.get_window_position()
         w, h = imgui.get_window_size()
         min_sz = min(w, h)
-        if aspect < 1:
-        w, h = imgui.get_window_size()
-        min_sz = min(w, h)
         if aspect < 1:
             w = min_sz * aspect
             h = min_sz
@@ -266,7 +303,6 @@ class WindowEvents(mglw.WindowConfig):
         with imgui.font(self.ui_font):
             # render box
             imgui.begin("Render", closable=False)  # , flags=imgui.WINDOW_NO_TITLE_BAR)
-            imgui.begin("Render", closable=False)  # , flags=imgui.WINDOW_NO_TITLE_BAR)
             self.render_quad_into_window(self.fbo_texture)
             imgui.end()
 
@@ -310,6 +346,12 @@ class WindowEvents(mglw.WindowConfig):
                     if clicked_quit:
                         self.close()
                         exit(1)
+                    clicked_save, _ = imgui.menu_item("Save preset", None, False, True)
+                    if clicked_save:
+                        self.save_preset()
+                    clicked_load, _ = imgui.menu_item("Load preset", None, False, True)
+                    if clicked_load:
+                        self.load_preset()
                     imgui.end_menu()
                 if imgui.begin_menu("Status", True):
                     made_alive, selected_alive = imgui.menu_item(
@@ -345,18 +387,22 @@ class WindowEvents(mglw.WindowConfig):
 
             imgui.text_colored("Visuals", 1.0, 1.0, 1.0, 0.5)
             self.ui_speed.slider("Speed")
+            self.ui_particle_render.combobox("Particles")
             # self.ui_show_particles.checkbox("Show particles")
 
-        imgui.text_colored("Audio", 1.0, 1.0, 1.0, 0.5)
+            imgui.text_colored("Audio", 1.0, 1.0, 1.0, 0.5)
 
-        feedback = self.audio_feedbacks.combobox("Audio fbk.")
-        if feedback:
-            self.set_feedback(feedback)
+            feedback = self.audio_feedbacks.combobox("Audio fbk.")
+            if feedback:
+                self.set_feedback(feedback)
 
-        # draw the gain sliders and update them
-        self.audio.gain_sliders()
+            # draw the gain sliders and update them
+            self.audio.gain_sliders()
+
+            # end the window before popping the font it was drawn with
+            imgui.end()
 
-        imgui.end()
+            self.profiler.panel()
 
         imgui.render()
         self.imgui.render(imgui.get_draw_data())
@@ -388,8 +434,9 @@ class WindowEvents(mglw.WindowConfig):
 
     def resize(self, width: int, height: int):
         super().resize(width, height)
-        proj = self.camera.projection.matrix
-        self.shaders["tex_quad"]["m_proj"].write(proj)
+        self.frame_data.set_camera(self.camera)
+        if not self.argv.capture:
+            self.set_render_size(self.resolution.set_base(self.render_base()))
         self.imgui.resize(width, height)
 
 
@@ -0,0 +1,59 @@
+import numpy as np
+
+# The FrameData uniform block (shaders/frame_data.glsl) as a numpy
+# struct with the std140 offsets: filled in place, written to one
+# uniform buffer once per frame and bound to every program, so the
+# per-frame uniform traffic does not grow with the number of programs.
+frame_dtype = np.dtype(
+    {
+        "names": [
+            "m_proj",
+            "m_camera",
+            "resolution",
+            "iTime",
+            "frame",
+            "audio_rms",
+            "audio_peak",
+        ],
+        "formats": ["(4,4)f4", "(4,4)f4", "2f4", "f4", "i4", "f4", "f4"],
+        "offsets": [0, 64, 128, 136, 140, 144, 148],
+        # std140 blocks round up to a multiple of 16 bytes
+        "itemsize": 160,
+    }
+)
+
+
+class FrameData:
+    """Per-frame uniforms in one buffer, bound to uniform block
+    binding point `binding`"""
+
+    block = "FrameData"
+
+    def __init__(self, ctx, binding=0):
+        self.binding = binding
+        self.data = np.zeros((), frame_dtype)
+        self.buffer = ctx.buffer(reserve=frame_dtype.itemsize, dynamic=True)
+        self.buffer.bind_to_uniform_block(binding)
+
+    def bind(self, program):
+        """Point program's FrameData block (if it uses it) at the buffer"""
+        if self.block in program:
+            program[self.block].binding = self.binding
+
+    def set_camera(self, camera):
+        """Copy a moderngl_window Camera's projection and view matrices"""
+        self.data["m_proj"] = camera.projection.matrix
+        self.data["m_camera"] = camera.matrix
+
+    def set_resolution(self, size):
+        self.data["resolution"] = size
+
+    def update(self, time, audio_rms=0.0, audio_peak=0.0):
+        """Set this frame's values and upload the block"""
+        data = self.data
+        data["iTime"] = time
+        data["frame"] += 1
+        data["audio_rms"] = audio_rms
+        data["audio_peak"] = audio_peak
+        # straight from the array: no per-frame bytes copy
+        self.buffer.write(data)
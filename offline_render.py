@@ -0,0 +1,241 @@
+import csv
+import math
+from pathlib import Path
+from time import perf_counter
+import numpy as np
+from audio_fbk import AudioServer, feedbacks
+
+# Render audio feedbacks headless, faster than real time, driven by
+# a recorded control trace. Useful for regression-testing sound
+# designs and for measuring what each graph costs per block.
+
+# control events in a trace
+STATE, PING = 0, 1
+
+trace_dtype = np.dtype([("t", "f8"), ("kind", "u1"), ("x", "f4"), ("y", "f4")])
+
+
+class ControlTrace:
+    """A timeline of control events: set_state(x, y) (kind STATE)
+    and ping() (kind PING), at t seconds from the start"""
+
+    def __init__(self, events):
+        self.events = np.sort(np.asarray(events, dtype=trace_dtype), order="t")
+
+    def __len__(self):
+        return len(self.events)
+
+    def duration(self):
+        return float(self.events["t"][-1]) if len(self.events) else 0.0
+
+    @classmethod
+    def load(cls, path):
+        """Load a trace from a .csv file (columns t, event, x, y,
+        where event is "state" or "ping"), a .npy file of
+        trace_dtype records, or a ZMQ message log (every
+        message becomes a ping)"""
+        path = Path(path)
+        if path.suffix == ".csv":
+            events = []
+            with open(path, newline="") as f:
+                for row in csv.DictReader(f):
+                    kind = PING if row["event"] == "ping" else STATE
+                    x, y = float(row.get("x") or 0), float(row.get("y") or 0)
+                    events.append((float(row["t"]), kind, x, y))
+            return cls(events)
+        if path.suffix == ".npy":
+            return cls(np.load(path))
+        from zmq_log import LogReader
+
+        reader = LogReader(path)
+        t_ns = np.array([t for t, frames in reader], dtype=np.int64)
+        reader.close()
+        events = np.zeros(len(t_ns), trace_dtype)
+        events["t"] = (t_ns - t_ns[0]) / 1e9 if len(t_ns) else 0
+        events["kind"] = PING
+        return cls(events)
+
+    @classmethod
+    def synthetic(cls, duration=10.0, state_rate=60.0, ping_rate=20.0, seed=0):
+        """Random-walk mouse movement plus Poisson pings"""
+        rng = np.random.default_rng(seed)
+        n_state = int(duration * state_rate)
+        n_ping = rng.poisson(duration * ping_rate)
+        events = np.zeros(n_state + n_ping, trace_dtype)
+        events["t"][:n_state] = np.arange(n_state) / state_rate
+        walk = np.cumsum(rng.normal(0, 0.02, (n_state, 2)), axis=0)
+        # fold the walk back into [0, 1]
+        walk = 1.0 - np.abs(np.mod(walk + 0.5, 2.0) - 1.0)
+        events["x"][:n_state], events["y"][:n_state] = walk.T
+        events["t"][n_state:] = rng.uniform(0, duration, n_ping)
+        events["kind"][n_state:] = PING
+        return cls(events)
+
+    def save(self, path):
+        np.save(path, self.events)
+
+
+def render(fbk, trace, path=None, duration=None, server=None):
+    """Render feedback class fbk driven by trace, as fast as
+    possible, optionally recording to a WAV file at path. Returns
+    per-block DSP cost statistics and the realtime factor"""
+    server = server or AudioServer(audio="manual", startup_sound=False)
+    pyo_server = server.server
+    graph = fbk(server)
+    graph.fade_in()
+    block = pyo_server.getBufferSize() / pyo_server.getSamplingRate()
+    duration = duration or trace.duration() + 1.0
+    n_blocks = math.ceil(duration / block)
+
+    if path is not None:
+        pyo_server.recordOptions(filename=str(path), fileformat=0, sampletype=1)
+        pyo_server.recstart()
+
+    events = trace.events
+    i = 0
+    costs = np.zeros(n_blocks)
+    for b in range(n_blocks):
+        # apply every event falling inside this block, then compute it
+        end = (b + 1) * block
+        while i < len(events) and events["t"][i] < end:
+            t, kind, x, y = events[i]
+            if kind == PING:
+                graph.ping()
+            else:
+                graph.set_state(float(x), float(y))
+            i += 1
+        t = perf_counter()
+        graph.update()
+        server.process()
+        costs[b] = perf_counter() - t
+
+    if path is not None:
+        pyo_server.recstop()
+    graph.close()
+    return block_stats(costs, block)
+
+
+def block_stats(costs, block):
+    """Summarise per-block DSP costs (seconds) against the block duration"""
+    p50, p99 = np.percentile(costs, [50, 99])
+    return {
+        "blocks": len(costs),
+        "block_us": block * 1e6,
+        "mean_us": costs.mean() * 1e6,
+        "p50_us": p50 * 1e6,
+        "p99_us": p99 * 1e6,
+        "max_us": costs.max() * 1e6,
+        # fraction of the block time spent computing it
+        "load": costs.mean() / block,
+        "realtime": len(costs) * block / costs.sum(),
+    }
+
+
+def format_stats(name, stats):
+    return (
+        f"{name:>10}: {stats['blocks']} blocks of {stats['block_us']:.0f}us, "
+        f"mean {stats['mean_us']:.1f}us p50 {stats['p50_us']:.1f}us "
+        f"p99 {stats['p99_us']:.1f}us max {stats['max_us']:.1f}us, "
+        f"load {stats['load']*100:.2f}%, {stats['realtime']:.0f}x realtime"
+    )
+
+
+def tune(
+    fbks,
+    trace,
+    buffer_sizes=(32, 64, 128, 256, 512, 1024),
+    sr=44100,
+    budget=0.5,
+    duration=None,
+):
+    """Render every feedback in fbks ({name: class}) at each buffer
+    size, and recommend the smallest size at which the p99 block
+    cost of every feedback stays within budget (a fraction of the
+    block duration; the rest is headroom for the rest of the process).
+    Returns (recommended buffer size or None, {size: {name: stats}})"""
+    results = {}
+    recommended = None
+    for size in sorted(buffer_sizes):
+        server = AudioServer(
+            audio="manual", sr=sr, buffersize=size, startup_sound=False
+        )
+        results[size] = {
+            name: render(fbk, trace, duration=duration, server=server)
+            for name, fbk in fbks.items()
+        }
+        server.close()
+        worst = max(
+            stats["p99_us"] / stats["block_us"] for stats in results[size].values()
+        )
+        if recommended is None and worst <= budget:
+            recommended = size
+    return recommended, results
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Offline feedback renderer")
+    parser.add_argument(
+        "trace", nargs="?", help="Control trace (.csv, .npy or ZMQ log)"
+    )
+    parser.add_argument(
+        "--fbk", action="append", help="Feedbacks to render (default: all)"
+    )
+    parser.add_argument("--out", default=None, help="Directory for rendered WAVs")
+    parser.add_argument(
+        "--duration", type=float, default=None, help="Seconds to render"
+    )
+    parser.add_argument(
+        "--synthetic", type=float, default=10.0, help="Synthetic trace length"
+    )
+    parser.add_argument(
+        "--tune",
+        action="store_true",
+        help="Find the smallest buffer size every feedback can run at",
+    )
+    parser.add_argument("--sr", type=int, default=44100, help="Sample rate")
+    parser.add_argument(
+        "--buffersize", type=int, default=256, help="Block size in samples"
+    )
+    parser.add_argument(
+        "--budget",
+        type=float,
+        default=0.5,
+        help="Fraction of each block the p99 DSP cost may use when tuning",
+    )
+    args = parser.parse_args()
+
+    if args.trace:
+        trace = ControlTrace.load(args.trace)
+    else:
+        trace = ControlTrace.synthetic(args.synthetic)
+    print(f"{len(trace)} control events over {trace.duration():.2f}s")
+
+    if args.tune:
+        fbks = {name: feedbacks[name] for name in args.fbk or feedbacks}
+        recommended, results = tune(
+            fbks, trace, sr=args.sr, budget=args.budget, duration=args.duration
+        )
+        for size, stats in results.items():
+            print(f"buffersize {size} ({size / args.sr * 1000:.1f}ms)")
+            for name in stats:
+                print(format_stats(name, stats[name]))
+        if recommended is None:
+            print("No buffer size fits the budget")
+        else:
+            ms = recommended / args.sr * 1000
+            print(f"Recommended: --buffersize {recommended} ({ms:.1f}ms latency)")
+        exit()
+
+    server = AudioServer(
+        audio="manual", sr=args.sr, buffersize=args.buffersize, startup_sound=False
+    )
+    for name in args.fbk or feedbacks:
+        path = None
+        if args.out:
+            Path(args.out).mkdir(parents=True, exist_ok=True)
+            path = Path(args.out) / f"{name}.wav"
+        stats = render(feedbacks[name], trace, path, args.duration, server)
+        print(format_stats(name, stats))
+    server.close()
@@ -0,0 +1,185 @@
+import time
+import moderngl
+import numpy as np
+from shader_manager import load_compute, load_program
+
+# GPU particle system: positions live in two SSBOs, and the dynamics
+# compute shader reads one and writes the other (ping-pong), so no
+# invocation ever reads a position another has already updated.
+
+# render paths, and the program each one draws with
+render_paths = {
+    "geometry": "shaders/particle.glsl",
+    "instanced": "shaders/particle_instanced.glsl",
+}
+
+# must match LOCAL_SIZE in the dynamics shader (set through its defines)
+LOCAL_SIZE = 128
+
+
+def random_positions(n, seed=None):
+    """n particles spread over [-1, 1] in x and y, at z=0"""
+    rng = np.random.default_rng(seed)
+    positions = rng.uniform(-1, 1, (n, 4)).astype(np.float32)
+    positions[:, 2] = 0.0
+    return positions
+
+
+class Particles:
+    """n particles as vec4 positions in a pair of SSBOs. step() runs
+    the dynamics shader from the current buffer into the other and
+    swaps them; render() draws the current buffer as points"""
+
+    def __init__(self, ctx, n, local_size=LOCAL_SIZE, positions=None):
+        self.ctx = ctx
+        self.n = n
+        self.local_size = local_size
+        self.groups = (n + local_size - 1) // local_size
+        max_groups = ctx.info["GL_MAX_COMPUTE_WORK_GROUP_COUNT"][0]
+        if self.groups > max_groups:
+            raise ValueError(
+                f"{n} particles need {self.groups} work groups, "
+                f"more than the {max_groups} this GL supports"
+            )
+        if positions is None:
+            positions = random_positions(n)
+        self.shape = positions.shape
+        self.buffers = [
+            ctx.buffer(positions.tobytes()),
+            ctx.buffer(reserve=positions.nbytes),
+        ]
+        self.current = 0
+        # vertex arrays, per (program, buffer)
+        self.vaos = {}
+        # ring of staging buffers for stage()/read_staged()
+        self.staging = []
+        self.staged = 0
+
+    def buffer(self):
+        """The buffer holding the latest positions"""
+        return self.buffers[self.current]
+
+    def step(self, program):
+        """Advance the particles one step with a dynamics compute shader"""
+        src, dst = self.buffers[self.current], self.buffers[1 - self.current]
+        src.bind_to_storage_buffer(0)
+        dst.bind_to_storage_buffer(1)
+        if "n_particles" in program:
+            program["n_particles"] = self.n
+        program.run(self.groups, 1, 1)
+        self.current = 1 - self.current
+
+    def render(self, program):
+        """Draw the particles as points (expanded into quads by
+        the geometry shader in particle.glsl)"""
+        key = (program.glo, self.current)
+        if key not in self.vaos:
+            self.vaos[key] = self.ctx.vertex_array(
+                program, [(self.buffer(), "4f", "in_position")]
+            )
+        self.vaos[key].render(moderngl.POINTS)
+
+    def forget(self, program):
+        """Release the vertex arrays built for program (e.g. when
+        a shader reload replaces it)"""
+        for key in [key for key in self.vaos if key[0] == program.glo]:
+            self.vaos.pop(key).release()
+
+    def render_instanced(self, program):
+        """Draw one instanced quad per particle; the vertex shader
+        (particle_instanced.glsl) reads positions from the SSBO"""
+        key = (program.glo, None)
+        if key not in self.vaos:
+            self.vaos[key] = self.ctx.vertex_array(program, [])
+        self.buffer().bind_to_storage_buffer(0)
+        self.vaos[key].render(moderngl.TRIANGLE_STRIP, vertices=4, instances=self.n)
+
+    def draw(self, program, path="geometry"):
+        """Render with the given path, "geometry" or "instanced" """
+        if path == "instanced":
+            self.render_instanced(program)
+        else:
+            self.render(program)
+
+    def stage(self, latency=2):
+        """Queue a GPU-side copy of the latest positions into a ring
+        of latency + 1 staging buffers; returns at once"""
+        if not self.staging:
+            nbytes = self.buffer().size
+            self.staging = [self.ctx.buffer(reserve=nbytes) for i in range(latency + 1)]
+        slot = self.staged % len(self.staging)
+        self.ctx.copy_buffer(self.staging[slot], self.buffer())
+        self.staged += 1
+
+    def read_staged(self, array):
+        """Copy the positions staged `latency` frames ago into array,
+        by which time the GPU has long finished the copy. Returns
+        False until that many frames have been staged"""
+        if self.staged < len(self.staging):
+            return False
+        self.staging[self.staged % len(self.staging)].read_into(array)
+        return True
+
+    def release(self):
+        for vao in self.vaos.values():
+            vao.release()
+        for buf in self.buffers + self.staging:
+            buf.release()
+
+
+def bench_particles(ctx, counts, paths=render_paths, frames=30, size=(1024, 1024)):
+    """Frame time (step + render into an offscreen FBO) against
+    particle count, for each render path. Returns
+    {path: [(count, ms per frame)]}"""
+    dynamics = load_compute(ctx, "shaders/dynamics.glsl", {"LOCAL_SIZE": LOCAL_SIZE})
+    dynamics["speed"] = 1.0
+    programs = {path: load_program(ctx, render_paths[path]) for path in paths}
+    fbo = ctx.simple_framebuffer(size)
+    fbo.use()
+    ctx.enable_only(moderngl.BLEND)
+    results = {path: [] for path in paths}
+    for n in counts:
+        particles = Particles(ctx, n)
+        for path, program in programs.items():
+            # warm up (shader specialisation, buffer upload)
+            particles.step(dynamics)
+            particles.draw(program, path)
+            ctx.finish()
+            t = time.perf_counter()
+            for i in range(frames):
+                fbo.clear()
+                particles.step(dynamics)
+                particles.draw(program, path)
+            ctx.finish()
+            results[path].append((n, (time.perf_counter() - t) / frames * 1000.0))
+        particles.release()
+    fbo.release()
+    return results
+
+
+if __name__ == "__main__":
+    # sweep particle count against frame time on a headless context
+    # (EGL, so this runs on llvmpipe without a display)
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Particle count benchmark")
+    parser.add_argument(
+        "--counts",
+        default="1000,10000,100000,1000000",
+        help="Comma-separated particle counts",
+    )
+    parser.add_argument(
+        "--paths", default="geometry,instanced", help="Render paths to compare"
+    )
+    parser.add_argument("--frames", type=int, default=30)
+    parser.add_argument("--backend", default="egl", help="moderngl context backend")
+    args = parser.parse_args()
+
+    ctx = moderngl.create_standalone_context(require=430, backend=args.backend)
+    print(f"{ctx.info['GL_RENDERER']} ({ctx.info['GL_VERSION']})")
+    counts = [int(c) for c in args.counts.split(",")]
+    results = bench_particles(ctx, counts, args.paths.split(","), args.frames)
+    for path, timings in results.items():
+        print(f"{path}:")
+        for n, ms in timings:
+            print(f"{n:>9} particles: {ms:8.2f} ms/frame ({1000.0 / ms:7.1f} fps)")
@@ -0,0 +1,179 @@
+import time
+from contextlib import contextmanager
+import imgui
+import numpy as np
+
+# Per-pass frame profiler. Each pass is wrapped in a GL time-elapsed
+# query plus a perf_counter CPU timing. Reading a query result waits
+# for the GPU, so queries go into a small ring of frames and are only
+# read back `latency` frames after they were issued, by which time the
+# GPU has long finished them.
+
+
+class RingStats:
+    """The last n samples of a timing (ms), with percentile summaries"""
+
+    def __init__(self, n=256):
+        self.values = np.zeros(n)
+        self.count = 0
+
+    def add(self, value):
+        self.values[self.count % len(self.values)] = value
+        self.count += 1
+
+    def samples(self):
+        return self.values[: min(self.count, len(self.values))]
+
+    def last(self):
+        return self.values[(self.count - 1) % len(self.values)] if self.count else 0.0
+
+    def summary(self):
+        """mean, p50, p95, p99 and max of the samples held, in ms"""
+        values = self.samples()
+        if not len(values):
+            return {"mean": 0.0, "p50": 0.0, "p95": 0.0, "p99": 0.0, "max": 0.0}
+        p50, p95, p99 = np.percentile(values, [50, 95, 99])
+        return {
+            "mean": values.mean(),
+            "p50": p50,
+            "p95": p95,
+            "p99": p99,
+            "max": values.max(),
+        }
+
+
+class FrameProfiler:
+    """GPU and CPU time per render pass. Wrap each pass in
+    `with profiler.section(name):` and call end_frame() once per
+    frame. GPU times lag the CPU times by `latency` frames"""
+
+    def __init__(self, ctx, latency=3, history=256, enabled=True):
+        self.ctx = ctx
+        self.latency = latency
+        self.history = history
+        self.enabled = enabled
+        # one {name: query} per in-flight frame; a slot is read back
+        # at the end of the frame before it is reused
+        self.queries = [{} for i in range(latency + 1)]
+        self.issued = [[] for i in range(latency + 1)]
+        self.cpu = {}
+        self.gpu = {}
+        self.frame_cpu = RingStats(history)
+        self.frame_gpu = RingStats(history)
+        # CPU time inside the (outermost) sections, excluding
+        # vsync and other waits between them
+        self.frame_work = RingStats(history)
+        self.work = 0.0
+        self.frame = 0
+        self.frame_start = None
+        # GL time queries cannot nest; inner sections are CPU-only
+        self.active = False
+
+    def reset(self):
+        """Forget all timings (e.g. after a warmup)"""
+        self.cpu, self.gpu = {}, {}
+        self.frame_cpu = RingStats(self.history)
+        self.frame_gpu = RingStats(self.history)
+        self.frame_work = RingStats(self.history)
+
+    def _stats(self, table, name):
+        if name not in table:
+            table[name] = RingStats(self.history)
+        return table[name]
+
+    @contextmanager
+    def section(self, name):
+        if not self.enabled:
+            yield
+            return
+        query = None
+        if not self.active:
+            slot = self.frame % len(self.queries)
+            if name not in self.queries[slot]:
+                self.queries[slot][name] = self.ctx.query(time=True)
+            query = self.queries[slot][name]
+            self.issued[slot].append(name)
+            self.active = True
+        t = time.perf_counter()
+        try:
+            if query is None:
+                yield
+            else:
+                with query:
+                    yield
+        finally:
+            ms = (time.perf_counter() - t) * 1000.0
+            self._stats(self.cpu, name).add(ms)
+            if query is not None:
+                self.active = False
+                self.work += ms
+
+    def end_frame(self):
+        """Close the frame, and read back the queries issued `latency`
+        frames ago (the slot the next frame will reuse)"""
+        if not self.enabled:
+            return
+        now = time.perf_counter()
+        if self.frame_start is not None:
+            self.frame_cpu.add((now - self.frame_start) * 1000.0)
+        self.frame_start = now
+        self.frame_work.add(self.work)
+        self.work = 0.0
+        self.frame += 1
+        if self.frame <= self.latency:
+            return
+        slot = self.frame % len(self.queries)
+        total = 0.0
+        for name in self.issued[slot]:
+            ms = self.queries[slot][name].elapsed / 1e6
+            self._stats(self.gpu, name).add(ms)
+            total += ms
+        if self.issued[slot]:
+            self.frame_gpu.add(total)
+        self.issued[slot] = []
+
+    def frame_time(self):
+        """Latest cost of a frame in ms: the slower of the summed CPU
+        and the summed GPU pass times (so time spent waiting for
+        vsync does not count)"""
+        return max(self.frame_work.last(), self.frame_gpu.last())
+
+    def summary(self):
+        """{name: {"cpu": summary, "gpu": summary}} per pass, plus
+        "frame" for whole frames"""
+        names = list(self.cpu) + [name for name in self.gpu if name not in self.cpu]
+        summary = {
+            name: {
+                "cpu": self._stats(self.cpu, name).summary(),
+                "gpu": self._stats(self.gpu, name).summary(),
+            }
+            for name in names
+        }
+        summary["frame"] = {
+            "cpu": self.frame_cpu.summary(),
+            "gpu": self.frame_gpu.summary(),
+            "work": self.frame_work.summary(),
+        }
+        return summary
+
+    def panel(self, title="Profiler"):
+        """Draw the timings as an imgui window"""
+        imgui.begin(title, True)
+        imgui.text_colored("ms      cpu p50/p99   gpu p50/p99", 1.0, 1.0, 1.0, 0.5)
+        for name, stats in self.summary().items():
+            cpu, gpu = stats["cpu"], stats["gpu"]
+            imgui.text(
+                f"{name:<8}{cpu['p50']:6.2f}/{cpu['p99']:6.2f} "
+                f"{gpu['p50']:6.2f}/{gpu['p99']:6.2f}"
+            )
+        imgui.end()
+
+    def export(self, monitor):
+        """Show the p50/p99 timings as Monitor watches"""
+        for name, stats in self.summary().items():
+            cpu, gpu = stats["cpu"], stats["gpu"]
+            monitor.watch(
+                f"{name} ms",
+                f"cpu {cpu['p50']:.2f}/{cpu['p99']:.2f} "
+                f"gpu {gpu['p50']:.2f}/{gpu['p99']:.2f}",
+            )
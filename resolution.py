@@ -0,0 +1,131 @@
+# Adaptive render resolution. The offscreen render target is scaled
+# in fixed steps of a base size (the largest size worth rendering at)
+# to keep the profiled frame time within a budget. Framebuffers come
+# from a pool keyed by size, so moving between steps reuses GPU memory
+# instead of reallocating it.
+
+
+def quantize(side, multiple=16):
+    return max(multiple, int(round(side / multiple)) * multiple)
+
+
+class FramebufferPool:
+    """Colour texture + depth framebuffers, one per size, created
+    on first use. Keeps at most max_size, dropping the least
+    recently used"""
+
+    def __init__(self, ctx, components=3, max_size=8):
+        self.ctx = ctx
+        self.components = components
+        self.max_size = max_size
+        # size -> (framebuffer, texture), least recently used first
+        self.pool = {}
+
+    def get(self, size):
+        """Return (framebuffer, colour texture) of the given size"""
+        size = tuple(size)
+        if size in self.pool:
+            self.pool[size] = self.pool.pop(size)
+            return self.pool[size]
+        texture = self.ctx.texture(size, self.components)
+        depth = self.ctx.depth_renderbuffer(size)
+        self.pool[size] = (self.ctx.framebuffer(texture, depth), texture)
+        while len(self.pool) > self.max_size:
+            self._release(next(iter(self.pool)))
+        return self.pool[size]
+
+    def _release(self, size):
+        fbo, texture = self.pool.pop(size)
+        for attachment in fbo.color_attachments + (fbo.depth_attachment,):
+            attachment.release()
+        fbo.release()
+
+    def release(self):
+        for size in list(self.pool):
+            self._release(size)
+
+
+class AdaptiveResolution:
+    """Choose a render size from a list of scales of base (w, h),
+    keeping the frame time (ms, one update() per frame) near
+    budget_ms. Hysteresis: it scales down only after down_frames
+    frames over budget, up only after up_frames frames in which the
+    larger size (cost assumed to grow with area) would still leave
+    headroom, and never within cooldown frames of a change (the GPU
+    timings lag the frames they measure)"""
+
+    def __init__(
+        self,
+        base,
+        budget_ms=1000.0 / 60.0,
+        scales=(0.5, 0.625, 0.75, 0.875, 1.0),
+        headroom=0.85,
+        down_frames=10,
+        up_frames=60,
+        cooldown=30,
+        smooth=0.1,
+        enabled=True,
+    ):
+        self.base = tuple(base)
+        self.budget_ms = budget_ms
+        self.scales = sorted(scales)
+        self.headroom = headroom
+        self.down_frames = down_frames
+        self.up_frames = up_frames
+        self.cooldown = cooldown
+        self.smooth = smooth
+        self.enabled = enabled
+        self.index = len(self.scales) - 1
+        self.frame_ms = None
+        self.over = self.under = 0
+        self.wait = cooldown
+
+    def scale(self):
+        return self.scales[self.index]
+
+    def size(self):
+        s = self.scale()
+        return tuple(quantize(side * s) for side in self.base)
+
+    def set_base(self, base):
+        """Change the full-scale size (e.g. on window resize);
+        returns the new size"""
+        self.base = tuple(base)
+        return self.size()
+
+    def update(self, frame_ms):
+        """Feed one frame's time; returns the new size if it changed,
+        otherwise None"""
+        if not self.enabled or frame_ms <= 0:
+            return None
+        if self.frame_ms is None:
+            self.frame_ms = frame_ms
+        self.frame_ms += (frame_ms - self.frame_ms) * self.smooth
+        if self.wait > 0:
+            self.wait -= 1
+            return None
+        budget = self.budget_ms
+        if self.frame_ms > budget:
+            self.over, self.under = self.over + 1, 0
+        elif self.index < len(self.scales) - 1:
+            growth = (self.scales[self.index + 1] / self.scale()) ** 2
+            if self.frame_ms * growth < budget * self.headroom:
+                self.over, self.under = 0, self.under + 1
+            else:
+                self.over = self.under = 0
+        else:
+            self.over = self.under = 0
+
+        if self.over >= self.down_frames and self.index > 0:
+            return self._step(-1)
+        if self.under >= self.up_frames:
+            return self._step(1)
+        return None
+
+    def _step(self, direction):
+        self.index += direction
+        self.over = self.under = 0
+        self.wait = self.cooldown
+        # the old estimate was at the old size
+        self.frame_ms = None
+        return self.size()
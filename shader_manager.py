@@ -0,0 +1,237 @@
+import hashlib
+import queue
+import re
+import threading
+from collections import OrderedDict
+from pathlib import Path
+
+# Shader loading with a source-hash cache and hot reload. A program's
+# key is the hash of its fully expanded source (#includes inlined,
+# #defines substituted), so a program is only compiled when what the
+# driver would see has changed. A background thread polls the shader
+# files, re-expands and re-hashes the programs that depend on changed
+# files, and queues the new sources; update(), called between frames
+# on the GL thread, compiles them and swaps them in. A failed compile
+# keeps the last good program. The cache is bounded: beyond
+# cache_size entries, the least recently used programs no longer in
+# use are released.
+
+include_re = re.compile(r'^#include\s+"([^"]+)"\s*$', re.M)
+
+# stages of a single-file program, as moderngl_window lays them out
+stages = ("VERTEX_SHADER", "GEOMETRY_SHADER", "FRAGMENT_SHADER")
+
+
+def apply_defines(source, defines=None):
+    """Replace the values of any "#define NAME value" lines in source"""
+    for name, value in (defines or {}).items():
+        source = re.sub(
+            rf"^#define\s+{name}\s.*$", f"#define {name} {value}", source, flags=re.M
+        )
+    return source
+
+
+def expand(path, defines=None, _seen=None):
+    """Read path, inlining #include "file" lines (relative to the
+    including file) and applying defines. Returns (source, files),
+    files being every file the source was built from"""
+    path = Path(path).resolve()
+    seen = set() if _seen is None else _seen
+    if path in seen:
+        raise ValueError(f"{path} includes itself")
+    seen.add(path)
+    files = {path}
+
+    def include(match):
+        source, included = expand(path.parent / match.group(1), None, seen)
+        files.update(included)
+        return source
+
+    with open(path) as f:
+        source = include_re.sub(include, f.read())
+    seen.discard(path)
+    return apply_defines(source, defines), files
+
+
+def source_hash(source, compute=False):
+    prefix = "compute\n" if compute else ""
+    return hashlib.sha1((prefix + source).encode()).hexdigest()
+
+
+def program_from_source(ctx, source):
+    """Build a render program from a single-file GLSL source (stages
+    wrapped in #if defined VERTEX_SHADER etc., as moderngl_window
+    expects), without needing a moderngl_window context"""
+    version, _, body = source.partition("\n")
+    shaders = {}
+    for stage in stages:
+        if stage in body:
+            shaders[stage.lower()] = f"{version}\n#define {stage}\n{body}"
+    return ctx.program(**shaders)
+
+
+def load_program(ctx, path, defines=None):
+    return program_from_source(ctx, expand(path, defines)[0])
+
+
+def load_compute(ctx, path, defines=None):
+    return ctx.compute_shader(expand(path, defines)[0])
+
+
+class ShaderManager:
+    """Load the programs {name: path} and compute shaders
+    {name: path} (with optional {name: defines}) into the dict
+    shaders. watch() starts hot reloading; call update() once per
+    frame to swap in recompiled programs. Functions in on_swap are
+    called as f(old, new) whenever a program is replaced, and must
+    drop anything built for old (e.g. vertex arrays): old stays
+    cached for a while, for reverted edits, but is then released"""
+
+    def __init__(
+        self,
+        ctx,
+        programs,
+        compute=None,
+        defines=None,
+        root=".",
+        poll=0.25,
+        cache_size=8,
+    ):
+        self.ctx = ctx
+        self.root = Path(root)
+        self.poll = poll
+        self.defines = defines or {}
+        self.paths = dict(programs)
+        self.paths.update(compute or {})
+        self.compute = set(compute or {})
+        self.shaders = {}
+        # source hash -> compiled program, least recently used first,
+        # so identical sources (and reverted edits) are not compiled twice
+        self.cache = OrderedDict()
+        self.cache_size = cache_size
+        self.released = 0
+        self.hashes = {}
+        self.files = {}
+        self.errors = {}
+        self.on_swap = []
+        self.compiled = self.reused = 0
+        self.queue = queue.SimpleQueue()
+        self.stop_event = threading.Event()
+        self.thread = None
+        for name in self.paths:
+            source, files = self.expand(name)
+            program = self.build(name, source)
+            if program is None:
+                raise RuntimeError(f"Could not compile {name}: {self.errors[name]}")
+            self.shaders[name] = program
+
+    def expand(self, name):
+        source, files = expand(self.root / self.paths[name], self.defines.get(name))
+        self.files[name] = files
+        return source, files
+
+    def build(self, name, source):
+        """Compile (or fetch from the cache) the program for source,
+        returning None (and recording the error) if it fails"""
+        key = source_hash(source, name in self.compute)
+        self.hashes[name] = key
+        if key in self.cache:
+            self.reused += 1
+            self.cache.move_to_end(key)
+            return self.cache[key]
+        try:
+            if name in self.compute:
+                program = self.ctx.compute_shader(source)
+            else:
+                program = program_from_source(self.ctx, source)
+        except Exception as e:
+            self.errors[name] = str(e)
+            return None
+        self.errors.pop(name, None)
+        self.compiled += 1
+        self.cache[key] = program
+        return program
+
+    def watch(self):
+        """Start polling the shader files in a background thread"""
+        self.thread = threading.Thread(target=self._watch, daemon=True)
+        self.thread.start()
+
+    def _mtimes(self):
+        files = set().union(*self.files.values())
+        mtimes = {}
+        for path in files:
+            try:
+                mtimes[path] = path.stat().st_mtime_ns
+            except OSError:
+                # mid-save; picked up on the next poll
+                pass
+        return mtimes
+
+    def _watch(self):
+        mtimes = self._mtimes()
+        while not self.stop_event.wait(self.poll):
+            now = self._mtimes()
+            changed = {path for path, t in now.items() if mtimes.get(path) != t}
+            mtimes.update(now)
+            if not changed:
+                continue
+            for name, files in list(self.files.items()):
+                if not files & changed:
+                    continue
+                try:
+                    source, files = expand(
+                        self.root / self.paths[name], self.defines.get(name)
+                    )
+                except (OSError, ValueError) as e:
+                    self.errors[name] = str(e)
+                    continue
+                # hash off the GL thread; unchanged sources never queue
+                if source_hash(source, name in self.compute) != self.hashes[name]:
+                    self.queue.put((name, source, files))
+
+    def update(self):
+        """Compile and swap in any changed programs (GL thread only).
+        Returns the names of the programs replaced"""
+        swapped = []
+        while True:
+            try:
+                name, source, files = self.queue.get_nowait()
+            except queue.Empty:
+                break
+            self.files[name] = files
+            program = self.build(name, source)
+            if program is None:
+                print(f"{name}: compile failed, keeping the last good program")
+                print(self.errors[name])
+                continue
+            old = self.shaders[name]
+            if program is old:
+                continue
+            self.shaders[name] = program
+            for f in self.on_swap:
+                f(old, program)
+            print(f"{name}: reloaded")
+            swapped.append(name)
+        if swapped:
+            self.evict()
+        return swapped
+
+    def evict(self):
+        """Release the least recently used cached programs not in
+        use, until at most cache_size remain"""
+        live = {id(program) for program in self.shaders.values()}
+        for key in list(self.cache):
+            if len(self.cache) <= self.cache_size:
+                break
+            program = self.cache[key]
+            if id(program) in live:
+                continue
+            del self.cache[key]
+            program.release()
+            self.released += 1
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
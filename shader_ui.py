@@ -1,33 +1,171 @@
+import math
 import imgui
 
-# class for shader variables
-# that are set via ui
-class ShaderCheckbox:
-    def __init__(self, shader, uniform, init_state=False):
-        self.state = init_state
+
+class Param:
+    """A tunable value with a range. set() only records the value
+    and marks the parameter dirty; update() pushes it to its
+    target (any callable) once, when it has changed. With smooth
+    (a time constant in seconds), update(dt) eases the pushed
+    value towards the set value over several frames instead"""
+
+    def __init__(
+        self, name, push, init=0.0, min=0.0, max=1.0, smooth=None, format="%.2f"
+    ):
+        self.name = name
+        self.push = push
+        self.min = min
+        self.max = max
+        self.smooth = smooth
+        self.format = format
+        self.value = init
+        # the value last sent to the target
+        self.current = init
+        self.dirty = True
+
+    def set(self, value):
+        if not isinstance(value, bool):
+            value = max(self.min, min(self.max, value))
+        if value != self.value:
+            self.value = value
+            self.dirty = True
+
+    def update(self, dt=None):
+        """Push the value if it changed; returns True if it did"""
+        if not self.dirty:
+            return False
+        if self.smooth and dt and not isinstance(self.value, bool):
+            self.current += (self.value - self.current) * (
+                1.0 - math.exp(-dt / self.smooth)
+            )
+            # snap once within 0.1% of the range
+            if abs(self.value - self.current) < 1e-3 * (self.max - self.min):
+                self.current = self.value
+        else:
+            self.current = self.value
+        self.dirty = self.current != self.value
+        self.push(self.current)
+        return True
+
+
+class ParamRegistry:
+    """A named set of Params, pushed together once per frame and
+    captured or applied together as (part of) a preset; the window
+    saves and loads the preset file"""
+
+    def __init__(self):
+        self.params = {}
+
+    def __getitem__(self, name):
+        return self.params[name]
+
+    def __contains__(self, name):
+        return name in self.params
+
+    def add(self, param):
+        self.params[param.name] = param
+        return param
+
+    def set(self, name, value):
+        self.params[name].set(value)
+
+    def update(self, dt=None):
+        """Push every changed parameter, returning how many were sent"""
+        return sum(param.update(dt) for param in self.params.values())
+
+    def slider(self, name, label=None):
+        param = self.params[name]
+        changed, value = imgui.slider_float(
+            label or name, param.value, param.min, param.max, param.format, 1.0
+        )
+        if changed:
+            param.set(value)
+
+    def checkbox(self, name, label=None):
+        param = self.params[name]
+        changed, value = imgui.checkbox(label or name, param.value)
+        if changed:
+            param.set(value)
+
+    def rebind(self, old, new):
+        """Point every parameter writing to program old at program
+        new (e.g. after a shader reload), and push them all again"""
+        for param in self.params.values():
+            if getattr(param, "shader", None) is old:
+                param.shader = new
+                param.push = uniform_target(new, param.uniform)
+                param.dirty = True
+
+    def preset(self):
+        """The current values, as a {name: value} dict"""
+        return {name: param.value for name, param in self.params.items()}
+
+    def apply(self, preset):
+        """Set every known parameter in preset (unknown names are ignored)"""
+        for name, value in preset.items():
+            if name in self.params:
+                self.params[name].set(value)
+
+
+def uniform_target(shader, uniform):
+    """A push function that writes a uniform in a GL program
+    (uniforms the compiler optimised away are skipped)"""
+
+    def push(value):
+        if uniform in shader:
+            shader[uniform] = float(value)
+
+    return push
+
+
+# shader variables that are set via ui; the uniform is only
+# written when the value changes (from update(), normally
+# called for the whole registry once per frame)
+class ShaderCheckbox(Param):
+    def __init__(self, shader, uniform, init_state=False, name=None):
+        super().__init__(
+            name or uniform, uniform_target(shader, uniform), init=init_state
+        )
         self.shader = shader
         self.uniform = uniform
 
     def checkbox(self, name):
-        _, self.state = imgui.checkbox(name, self.state)
-        self.shader[self.uniform] = 1.0 if self.state else 0.0
+        changed, state = imgui.checkbox(name, self.value)
+        if changed:
+            self.set(state)
 
 
-# Slider directly setting a uniform in a shader
-class ShaderSlider:
-    def __init__(self, shader, uniform, min=0.0, max=1.0, init=0.5, format="%.2f"):
-        self.min = min
-        self.max = max
-        self.state = init
+# Slider setting a uniform in a shader
+class ShaderSlider(Param):
+    def __init__(
+        self,
+        shader,
+        uniform,
+        min=0.0,
+        max=1.0,
+        init=0.5,
+        format="%.2f",
+        smooth=None,
+        name=None,
+    ):
+        super().__init__(
+            name or uniform,
+            uniform_target(shader, uniform),
+            init=init,
+            min=min,
+            max=max,
+            smooth=smooth,
+            format=format,
+        )
         self.shader = shader
         self.uniform = uniform
-        self.format = format
 
     def slider(self, name):
-        _, self.state = imgui.slider_float(
-            name, self.state, self.min, self.max, self.format, 1.0
+        changed, state = imgui.slider_float(
+            name, self.value, self.min, self.max, self.format, 1.0
         )
-        self.shader[self.uniform] = self.state
+        if changed:
+            self.set(state)
 
 
 # simple list selector for pyimgui
@@ -1,18 +1,27 @@
 #version 430
+#define LOCAL_SIZE 128
 uniform float speed;
+uniform uint n_particles;
 
-layout (local_size_x=128) in;
+layout (local_size_x=LOCAL_SIZE) in;
 
-layout(std430, binding=0) buffer pos{
+// ping-pong: read last frame's positions, write this frame's
+layout(std430, binding=0) readonly buffer pos_in{
     vec4 Position[];
 };
 
+layout(std430, binding=1) writeonly buffer pos_out{
+    vec4 NewPosition[];
+};
+
 void main()
 {
     uint index = gl_GlobalInvocationID.x;
+    // the last work group may run past the end
+    if (index >= n_particles) return;
     vec4 pos = Position[index];
-    
+
     float y = pos.y + pos.x * 0.01 * speed; // integrate
     y = (mod(y+1.0, 2.0)-1.0); //wrap
-    Position[index] = vec4(pos.x, y, pos.z, 0.0);   //write back
-}
\ No newline at end of file
+    NewPosition[index] = vec4(pos.x, y, pos.z, 0.0);   //write
+}
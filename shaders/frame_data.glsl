@@ -0,0 +1,11 @@
+// per-frame values shared by every program: one std140 block,
+// packed by frame_data.py and uploaded once per frame
+layout(std140) uniform FrameData {
+    mat4 m_proj;
+    mat4 m_camera;
+    vec2 resolution;    // render target size in pixels
+    float iTime;        // time in seconds
+    int frame;
+    float audio_rms;
+    float audio_peak;
+};
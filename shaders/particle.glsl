@@ -1,4 +1,5 @@
 #version 330
+#include "frame_data.glsl"
 
 #if defined VERTEX_SHADER
 
@@ -26,10 +27,10 @@ out vec2 texCoord;
 in vec3 vpos[1];
 out vec3 gpos;
 
-// generate micro quads for each point
+// generate micro quads for each point, swelling with the audio
 void main()
 {
-    float d = 0.006;
+    float d = 0.006 * (1.0 + 2.0 * audio_peak);
     gpos = vpos[0];
     vec3 pos = gl_in[0].gl_Position.xyz;
     
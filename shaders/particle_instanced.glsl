@@ -0,0 +1,40 @@
+#version 430
+#include "frame_data.glsl"
+
+// the same stripe-shaded quads as particle.glsl, without a geometry
+// shader: one instance per particle, reading its position straight
+// from the particle SSBO, with the 4 quad corners from gl_VertexID
+
+#if defined VERTEX_SHADER
+
+layout(std430, binding=0) readonly buffer pos_in{
+    vec4 Position[];
+};
+
+out vec2 texCoord;
+out vec3 gpos;
+
+void main() {
+    vec3 pos = Position[gl_InstanceID].xyz;
+    // triangle strip corners: (0,0), (1,0), (0,1), (1,1)
+    vec2 corner = vec2(gl_VertexID & 1, gl_VertexID >> 1);
+    float d = 0.006 * (1.0 + 2.0 * audio_peak);
+    texCoord = corner;
+    gpos = pos;
+    gl_Position = vec4(pos.xy + (corner * 2.0 - 1.0) * d, pos.z, 1.0);
+}
+
+#elif defined FRAGMENT_SHADER
+
+in vec2 texCoord;
+in vec3 gpos;
+out vec4 fragColor;
+
+void main() {
+    // colour the point with a vertical stripe
+    float tc = max(0, 1.0-2*length((texCoord-vec2(0.5, 0.5))*vec2(3.0, 1.0)));
+    // fade out at top and bottom
+    float fade = 1.0/(1.0+length(gpos.y*3.0));
+    fragColor = vec4(1.0, 1.0, 1.0, tc*0.4*fade);
+}
+#endif
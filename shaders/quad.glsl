@@ -1,4 +1,5 @@
 #version 330
+#include "frame_data.glsl"
 
 #if defined VERTEX_SHADER
 
@@ -19,8 +20,9 @@ out vec4 fragColor;
 
 in vec3 pos;
 in vec3 normal;
-uniform float iTime;
 uniform float range;
+// audio analysis: log magnitude per bin (levels are in FrameData)
+uniform sampler2D audio_spectrum;
 
 float gauss(float x, float u, float w)
 {
@@ -50,7 +52,10 @@ void main() {
     float k = 12.0;
     float grid_line = cos(rate) * exp(cos(rate) * k - k);    
     float fade = smoothstep(0.0, 1.0, iTime) + 0.00001 * range;    
-    fragColor = fade * gradient(pos)  + grid_line * 0.1;
+    // spectrum bars rising from the bottom, low frequencies on the left
+    float level = texture(audio_spectrum, vec2(pos.x * 0.5 + 0.5, 0.5)).r;
+    float bar = smoothstep(0.0, 0.02, level * 0.25 - (pos.y * 0.5 + 0.5));
+    fragColor = fade * gradient(pos) * (1.0 + audio_rms) + grid_line * 0.1 + bar * 0.05;
     fragColor.a = 1.0;
 }
 #endif
@@ -1,4 +1,5 @@
 #version 330
+#include "frame_data.glsl"
 
 #if defined VERTEX_SHADER
 
@@ -6,8 +7,6 @@ in vec3 in_position;
 in vec2 in_texcoord_0;
 
 uniform mat4 m_model;
-uniform mat4 m_camera;
-uniform mat4 m_proj;
 
 out vec2 texCoord;
 
@@ -23,7 +22,6 @@ void main() {
 #elif defined FRAGMENT_SHADER
 
 uniform sampler2D tex;  // texture to render
-uniform float iTime;    // time in seconds
 in vec2 texCoord;       // UV coords
 out vec4 fragColor;     // output RGBA
 
@@ -0,0 +1,288 @@
+import sys
+import time
+from contextlib import nullcontext
+from multiprocessing import Lock
+from multiprocessing.shared_memory import SharedMemory
+import numpy as np
+
+# header layout (int64 counters at the start of the block)
+# (each counter has a single writer: the producer, or the consumer)
+_WRITE, _READ, _RELEASE, _DROPPED, _OVERSIZE, _BLOCKED, _TOTAL = range(7)
+_BAD_PUT, _BAD_DRAIN = 7, 8
+_HEADER_SLOTS = 16
+
+policies = ("drop_oldest", "block")
+
+
+def _attach(name):
+    """Attach to an existing shared memory block without
+    letting this process's resource tracker unlink it on exit"""
+    shm = SharedMemory(name=name, create=False)
+    if sys.platform != "win32":
+        from multiprocessing import resource_tracker
+
+        resource_tracker.unregister(shm._name, "shared_memory")
+    return shm
+
+
+class ShmRing:
+    """Bounded single-producer, single-consumer ring buffer
+    of fixed-size slots in shared memory.
+
+    The producer (the relay worker) copies each message into a
+    slot; the consumer (the render thread) takes a whole batch
+    with drain().
+
+    When the ring is full, policy "drop_oldest" discards the oldest
+    message the consumer has not yet drained, and "block" waits for
+    the consumer to make space. With "block", drain() returns
+    memoryviews straight into the shared block, valid until the
+    next call to drain() or release(). With "drop_oldest", drain()
+    returns copies (bytes) and hands the slots straight back, so a
+    batch the consumer is still holding never forces the producer
+    to drop new messages instead of old ones.
+
+    Messages longer than slot_size are dropped (and counted as
+    oversize); the first one is reported on stderr."""
+
+    def __init__(self, n_slots=4096, slot_size=1024, policy="drop_oldest", name=None):
+        if policy not in policies:
+            raise ValueError(
+                f"Unknown ring policy {policy}, expected one of {policies}"
+            )
+        self.n_slots = n_slots
+        self.slot_size = slot_size
+        self.policy = policy
+        self.owner = name is None
+        if self.owner:
+            self.shm = SharedMemory(create=True, size=self._size())
+        else:
+            self.shm = _attach(name)
+        # only the drop_oldest policy lets the producer move the read pointer
+        self.lock = Lock() if policy == "drop_oldest" else None
+        self._map()
+        if self.owner:
+            self.header[:] = 0
+
+    def _size(self):
+        return _HEADER_SLOTS * 8 + self.n_slots * 4 + self.n_slots * self.slot_size
+
+    def _map(self):
+        buf = self.shm.buf
+        lengths_at = _HEADER_SLOTS * 8
+        self.data_at = lengths_at + self.n_slots * 4
+        self.header = np.ndarray((_HEADER_SLOTS,), np.int64, buf, 0)
+        self.lengths = np.ndarray((self.n_slots,), np.int32, buf, lengths_at)
+        self.mv = buf
+        # the batch handed out by the last drain()
+        self.batch = []
+
+    def __getstate__(self):
+        return {
+            "name": self.shm.name,
+            "n_slots": self.n_slots,
+            "slot_size": self.slot_size,
+            "policy": self.policy,
+            "lock": self.lock,
+        }
+
+    def __setstate__(self, state):
+        self.n_slots = state["n_slots"]
+        self.slot_size = state["slot_size"]
+        self.policy = state["policy"]
+        self.lock = state["lock"]
+        self.owner = False
+        self.shm = _attach(state["name"])
+        self._map()
+
+    def _guard(self):
+        return self.lock if self.lock is not None else nullcontext()
+
+    def __len__(self):
+        return int(self.header[_WRITE] - self.header[_READ])
+
+    def put(self, data, timeout=1.0):
+        """Copy one message into the ring. Returns False
+        if the message was dropped"""
+        h = self.header
+        data = memoryview(data).cast("B")
+        n = len(data)
+        if n > self.slot_size:
+            if not h[_OVERSIZE]:
+                print(
+                    f"ShmRing: dropping {n} byte message (slot_size is "
+                    f"{self.slot_size}); further oversize messages are "
+                    "only counted",
+                    file=sys.stderr,
+                )
+            h[_OVERSIZE] += 1
+            return False
+
+        if h[_WRITE] - h[_RELEASE] >= self.n_slots:
+            if self.policy == "drop_oldest":
+                with self.lock:
+                    if h[_WRITE] - h[_RELEASE] < self.n_slots:
+                        # drained since the check above
+                        pass
+                    elif h[_READ] == h[_RELEASE]:
+                        # drop the oldest pending message
+                        h[_READ] += 1
+                        h[_RELEASE] += 1
+                        h[_DROPPED] += 1
+                    else:
+                        # only while drain() is copying a batch out
+                        h[_DROPPED] += 1
+                        return False
+            else:
+                h[_BLOCKED] += 1
+                deadline = time.perf_counter() + timeout
+                while h[_WRITE] - h[_RELEASE] >= self.n_slots:
+                    if time.perf_counter() > deadline:
+                        h[_DROPPED] += 1
+                        return False
+                    time.sleep(0.0001)
+
+        w = int(h[_WRITE])
+        slot = w % self.n_slots
+        at = self.data_at + slot * self.slot_size
+        self.mv[at : at + n] = data
+        self.lengths[slot] = n
+        # publish only once the slot is complete
+        h[_WRITE] = w + 1
+        h[_TOTAL] += 1
+        return True
+
+    def drain(self, max_items=None):
+        """Return a batch of up to max_items messages: memoryviews
+        into shared memory with the "block" policy (the previous
+        batch is released first), bytes with "drop_oldest"."""
+        h = self.header
+        self._release_views()
+        with self._guard():
+            h[_RELEASE] = h[_READ]
+            start = int(h[_READ])
+            end = int(h[_WRITE])
+            if max_items is not None:
+                end = min(end, start + max_items)
+            h[_READ] = end
+
+        views = []
+        for i in range(start, end):
+            slot = i % self.n_slots
+            at = self.data_at + slot * self.slot_size
+            views.append(self.mv[at : at + int(self.lengths[slot])])
+        if self.policy == "drop_oldest":
+            # copy out and hand the slots back at once
+            msgs = [bytes(view) for view in views]
+            for view in views:
+                view.release()
+            with self.lock:
+                h[_RELEASE] = h[_READ]
+            return msgs
+        self.batch = views
+        return views
+
+    def _release_views(self):
+        # invalidate the previous batch, so stale views raise rather
+        # than silently reading slots the producer has reused
+        for view in self.batch:
+            try:
+                view.release()
+            except BufferError:
+                # still exported (e.g. wrapped by np.frombuffer)
+                pass
+        self.batch = []
+
+    def release(self):
+        """Hand the last drained batch back to the producer"""
+        self._release_views()
+        with self._guard():
+            self.header[_RELEASE] = self.header[_READ]
+
+    def count_bad(self, n=1, consumer=False):
+        """Count n malformed messages, dropped by the producer
+        (or with consumer=True, by the consumer)"""
+        self.header[_BAD_DRAIN if consumer else _BAD_PUT] += n
+
+    def stats(self):
+        h = self.header
+        return {
+            "total": int(h[_TOTAL]),
+            "pending": int(h[_WRITE] - h[_READ]),
+            "dropped": int(h[_DROPPED]),
+            "oversize": int(h[_OVERSIZE]),
+            "blocked": int(h[_BLOCKED]),
+            "bad": int(h[_BAD_PUT] + h[_BAD_DRAIN]),
+        }
+
+    def close(self):
+        # drop our own views so the block can be unmapped; any views
+        # still held by the caller keep the mapping alive until freed
+        self._release_views()
+        del self.header, self.lengths, self.mv
+        try:
+            self.shm.close()
+        except BufferError:
+            pass
+        if self.owner:
+            self.shm.unlink()
+
+
+def _queue_producer(q, n, size):
+    msg = bytes(size)
+    for i in range(n):
+        q.put(msg)
+    q.put(None)
+
+
+def _ring_producer(ring, n, size):
+    msg = bytes(size)
+    for i in range(n):
+        ring.put(msg)
+
+
+if __name__ == "__main__":
+    # throughput benchmark: Queue + poll() vs. ShmRing + drain()
+    import argparse
+    from multiprocessing import Process, Queue
+
+    parser = argparse.ArgumentParser(description="ShmRing vs. Queue throughput")
+    parser.add_argument("--n", type=int, default=200000, help="Messages to send")
+    parser.add_argument("--size", type=int, default=64, help="Payload bytes")
+    parser.add_argument("--batch", type=int, default=1024, help="drain() batch size")
+    args = parser.parse_args()
+
+    q = Queue()
+    p = Process(target=_queue_producer, args=(q, args.n, args.size))
+    t = time.perf_counter()
+    p.start()
+    received = 0
+    while True:
+        msg = q.get()
+        if msg is None:
+            break
+        received += 1
+    queue_time = time.perf_counter() - t
+    p.join()
+    print(
+        f"Queue:   {received} msgs in {queue_time:.3f}s {received/queue_time:10.0f} msg/s"
+    )
+
+    ring = ShmRing(n_slots=8192, slot_size=max(args.size, 64), policy="block")
+    p = Process(target=_ring_producer, args=(ring, args.n, args.size))
+    t = time.perf_counter()
+    p.start()
+    received = 0
+    while received < args.n:
+        batch = ring.drain(args.batch)
+        received += len(batch)
+        if not batch:
+            time.sleep(0)
+    ring_time = time.perf_counter() - t
+    p.join()
+    del batch
+    print(
+        f"ShmRing: {received} msgs in {ring_time:.3f}s {received/ring_time:10.0f} msg/s"
+    )
+    print(f"Speedup: {queue_time/ring_time:.1f}x {ring.stats()}")
+    ring.close()
@@ -0,0 +1,109 @@
+import json
+import time
+import numpy as np
+import pytest
+from decoders import Coalescer, JsonDecoder, RecordDecoder, StructDecoder
+from shm_ring import ShmRing
+
+point = StructDecoder("<ff", ["x", "y"])
+
+
+@pytest.fixture
+def ring():
+    ring = ShmRing(n_slots=16, slot_size=64)
+    yield ring
+    ring.close()
+
+
+def packet(**values):
+    return json.dumps(values).encode()
+
+
+def test_latest(ring):
+    coalescer = Coalescer(JsonDecoder(), "latest")
+    coalescer.add(packet(x=1, y=2), ring)
+    coalescer.add(packet(x=3), ring)
+    coalescer.flush(ring)
+    assert coalescer.unpack(ring.drain()) == (2, {"x": 3, "y": 2})
+
+
+def test_latest_records():
+    coalescer = Coalescer(RecordDecoder(point.dtype), "latest")
+    ring = ShmRing(n_slots=4, slot_size=256)
+    try:
+        coalescer.add(np.array([(1, 2), (3, 4)], point.dtype).tobytes(), ring)
+        coalescer.flush(ring)
+        assert coalescer.unpack(ring.drain()) == (1, {"x": 3.0, "y": 4.0})
+    finally:
+        ring.close()
+
+
+def test_stack(ring):
+    coalescer = Coalescer(point, "stack")
+    for i in range(3):
+        coalescer.add(np.array([(i, -i)], point.dtype).tobytes(), ring)
+    coalescer.flush(ring)
+    count, value = coalescer.unpack(ring.drain())
+    assert count == 3
+    assert value["x"].tolist() == [0, 1, 2]
+
+
+def test_stack_splits_across_slots(ring):
+    coalescer = Coalescer(point, "stack", flush_ms=0.0)
+    # 8 byte records, 64 byte slots: 20 records need three slots
+    for i in range(20):
+        coalescer.add(np.array([(i, 0)], point.dtype).tobytes(), ring)
+    coalescer.flush(ring)
+    msgs = ring.drain()
+    assert [len(m) for m in msgs] == [64, 64, 32]
+    count, value = coalescer.unpack(msgs)
+    assert count == 20
+    assert value["x"].tolist() == list(range(20))
+
+
+def test_stack_rejects_oversize(ring):
+    coalescer = Coalescer(point, "stack")
+    with pytest.raises(ValueError):
+        coalescer.add(bytes(72), ring)
+    with pytest.raises(ValueError):
+        coalescer.add(bytes(5), ring)
+    # nothing (not even an empty batch) was written
+    coalescer.flush(ring)
+    assert ring.drain() == []
+
+
+def test_conflate(ring):
+    coalescer = Coalescer(JsonDecoder(), "conflate")
+    for i in range(5):
+        coalescer.add(packet(i=i), ring)
+    coalescer.flush(ring)
+    assert coalescer.unpack(ring.drain()) == (5, {"i": 4})
+
+
+def test_flush_ms(ring):
+    coalescer = Coalescer(JsonDecoder(), "latest", flush_ms=50.0)
+    coalescer.add(packet(a=1), ring)
+    # the ring is empty, so the batch goes at once
+    coalescer.flush(ring)
+    assert len(ring) == 1
+    coalescer.add(packet(a=2), ring)
+    # the host has not taken the last batch, and it is still fresh
+    coalescer.flush(ring)
+    assert len(ring) == 1
+    time.sleep(0.06)
+    coalescer.flush(ring)
+    assert len(ring) == 2
+    assert coalescer.unpack(ring.drain()) == (2, {"a": 2})
+
+
+def test_latest_split_across_slots(ring):
+    coalescer = Coalescer(JsonDecoder(), "latest")
+    for i in range(20):
+        coalescer.add(packet(**{f"key{i}": i}), ring)
+    coalescer.flush(ring)
+    msgs = ring.drain()
+    assert len(msgs) > 1
+    assert all(len(m) <= ring.slot_size for m in msgs)
+    count, state = coalescer.unpack(msgs)
+    assert count == 20
+    assert state == {f"key{i}": i for i in range(20)}
@@ -0,0 +1,62 @@
+import struct
+from pathlib import Path
+import numpy as np
+import pytest
+from frame_data import FrameData, frame_dtype
+
+# std140 layout of the FrameData block in shaders/frame_data.glsl
+std140 = {
+    "m_proj": 0,
+    "m_camera": 64,
+    "resolution": 128,
+    "iTime": 136,
+    "frame": 140,
+    "audio_rms": 144,
+    "audio_peak": 148,
+}
+
+
+def test_offsets():
+    assert {name: frame_dtype.fields[name][1] for name in std140} == std140
+    assert frame_dtype.itemsize == 160
+
+
+def test_gl_layout():
+    # read each member back through the block in a compute shader
+    moderngl = pytest.importorskip("moderngl")
+    ctx = None
+    for kwargs in ({}, {"backend": "egl"}):
+        try:
+            ctx = moderngl.create_standalone_context(require=430, **kwargs)
+            break
+        except Exception:
+            pass
+    if ctx is None:
+        pytest.skip("no GL 4.3 context")
+    block = (Path(__file__).parent / "shaders" / "frame_data.glsl").read_text()
+    shader = ctx.compute_shader(
+        "#version 430\nlayout(local_size_x=1) in;\n" + block + """
+        layout(std430, binding=1) buffer Out { float values[]; };
+        void main() {
+            values[0] = m_proj[1][2];
+            values[1] = m_camera[3][0];
+            values[2] = resolution.y;
+            values[3] = iTime;
+            values[4] = float(frame);
+            values[5] = audio_rms;
+            values[6] = audio_peak;
+        }
+        """
+    )
+    frame_data = FrameData(ctx)
+    frame_data.bind(shader)
+    data = frame_data.data
+    data["m_proj"][1, 2] = 1.5
+    data["m_camera"][3, 0] = 2.5
+    data["resolution"] = (640, 480)
+    frame_data.update(3.5, 0.25, 0.75)
+    out = ctx.buffer(reserve=7 * 4)
+    out.bind_to_storage_buffer(1)
+    shader.run(1)
+    assert struct.unpack("7f", out.read()) == (1.5, 2.5, 480.0, 3.5, 1.0, 0.25, 0.75)
+    assert np.array_equal(np.frombuffer(frame_data.buffer.read(), frame_dtype), [data])
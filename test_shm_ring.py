@@ -0,0 +1,127 @@
+import pytest
+from shm_ring import ShmRing
+
+
+@pytest.fixture
+def ring(request):
+    ring = ShmRing(**request.param)
+    yield ring
+    ring.close()
+
+
+def msg(i, size=8):
+    return i.to_bytes(size, "little")
+
+
+def number(m):
+    return int.from_bytes(m, "little")
+
+
+@pytest.mark.parametrize("ring", [dict(n_slots=64, slot_size=8)], indirect=True)
+def test_drop_oldest_keeps_newest(ring):
+    # 100 messages per frame into 64 slots, one drain per frame
+    sent = 0
+    for frame in range(6):
+        for i in range(100):
+            ring.put(msg(sent))
+            sent += 1
+        batch = ring.drain()
+        assert [number(m) for m in batch] == list(range(sent - 64, sent))
+    assert ring.stats()["dropped"] == 6 * 36
+
+
+@pytest.mark.parametrize("ring", [dict(n_slots=4, slot_size=8)], indirect=True)
+def test_drop_oldest_batch_outlives_drain(ring):
+    for i in range(4):
+        ring.put(msg(i))
+    batch = ring.drain()
+    for i in range(4, 8):
+        assert ring.put(msg(i))
+    assert [number(m) for m in batch] == [0, 1, 2, 3]
+    assert [number(m) for m in ring.drain()] == [4, 5, 6, 7]
+
+
+@pytest.mark.parametrize(
+    "ring", [dict(n_slots=4, slot_size=8, policy="block")], indirect=True
+)
+def test_block_times_out(ring):
+    for i in range(4):
+        assert ring.put(msg(i))
+    assert not ring.put(msg(4), timeout=0.01)
+    stats = ring.stats()
+    assert stats["blocked"] == 1
+    assert stats["dropped"] == 1
+    # a drained batch still holds its slots until release()
+    batch = ring.drain()
+    assert not ring.put(msg(4), timeout=0.01)
+    assert [number(m) for m in batch] == [0, 1, 2, 3]
+    ring.release()
+    assert ring.put(msg(4), timeout=0.01)
+
+
+@pytest.mark.parametrize(
+    "ring", [dict(n_slots=4, slot_size=8, policy="block")], indirect=True
+)
+def test_block_views_invalidated_on_drain(ring):
+    ring.put(msg(1))
+    view = ring.drain()[0]
+    assert number(view) == 1
+    ring.drain()
+    with pytest.raises(ValueError):
+        bytes(view)
+
+
+@pytest.mark.parametrize("policy", ["drop_oldest", "block"])
+def test_oversize(policy, capsys):
+    ring = ShmRing(n_slots=4, slot_size=8, policy=policy)
+    try:
+        assert not ring.put(bytes(9))
+        assert not ring.put(bytes(100))
+        assert ring.put(bytes(8))
+        assert ring.stats()["oversize"] == 2
+        assert len(ring.drain()) == 1
+        # reported once, then only counted
+        assert capsys.readouterr().err.count("slot_size") == 1
+    finally:
+        ring.close()
+
+
+class DrainOnLock:
+    """Lock stand-in that lets the consumer drain the ring between
+    put()'s unlocked full check and its taking the lock"""
+
+    def __init__(self, ring):
+        self.ring = ring
+        self.lock = ring.lock
+        self.armed = True
+
+    def __enter__(self):
+        if self.armed:
+            self.armed = False
+            self.drained = self.ring.drain()
+        self.lock.acquire()
+
+    def __exit__(self, *exc):
+        self.lock.release()
+
+
+@pytest.mark.parametrize("ring", [dict(n_slots=4, slot_size=8)], indirect=True)
+def test_drop_oldest_drained_before_lock(ring):
+    for i in range(4):
+        ring.put(msg(i))
+    ring.lock = lock = DrainOnLock(ring)
+    assert ring.put(msg(4))
+    assert [number(m) for m in lock.drained] == [0, 1, 2, 3]
+    stats = ring.stats()
+    assert stats["dropped"] == 0
+    assert stats["pending"] == 1
+    assert [number(m) for m in ring.drain()] == [4]
+
+
+@pytest.mark.parametrize(
+    "ring", [dict(n_slots=4, slot_size=8, policy="block")], indirect=True
+)
+def test_bad_counted_per_side(ring):
+    ring.count_bad()
+    ring.count_bad(2, consumer=True)
+    assert ring.stats()["bad"] == 3
@@ -0,0 +1,65 @@
+import threading
+import zmq
+from zmq_log import LogReader, LogWriter, replay
+
+
+def messages(n):
+    return [[b"topic%d" % (i % 3), b"payload %d" % i, bytes(i % 7)] for i in range(n)]
+
+
+def record(path, msgs):
+    writer = LogWriter(path)
+    for i, frames in enumerate(msgs):
+        writer.write(frames, t_ns=i * 1000)
+    writer.close()
+
+
+def test_round_trip(tmp_path):
+    path = tmp_path / "log.zmq"
+    msgs = messages(750)
+    record(path, msgs)
+    reader = LogReader(path)
+    read = [(t_ns, [bytes(f) for f in frames]) for t_ns, frames in reader]
+    count, duration, topics = reader.info()
+    reader.close()
+    assert read == [(i * 1000, frames) for i, frames in enumerate(msgs)]
+    assert count == 750
+    assert topics == {"topic0": 250, "topic1": 250, "topic2": 250}
+
+
+def test_replay(tmp_path):
+    path = tmp_path / "log.zmq"
+    msgs = messages(200)
+    record(path, msgs)
+    address = f"ipc://{tmp_path}/replay"
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.SUB)
+    sock.setsockopt(zmq.SUBSCRIBE, b"")
+    sock.setsockopt(zmq.RCVHWM, 0)
+    sock.connect(address)
+    result = []
+    thread = threading.Thread(
+        target=lambda: result.append(replay(path, address, threading.Event(), 0))
+    )
+    thread.start()
+    received = []
+    while len(received) < len(msgs) and sock.poll(2000):
+        received.append(sock.recv_multipart())
+    thread.join()
+    sock.close()
+    ctx.term()
+    assert result == [200]
+    assert received == msgs
+
+
+def test_replay_empty_log_loop_returns(tmp_path):
+    path = tmp_path / "empty.zmq"
+    record(path, [])
+    stop = threading.Event()
+    thread = threading.Thread(
+        target=replay, args=(path, f"ipc://{tmp_path}/empty", stop, 0, True)
+    )
+    thread.start()
+    thread.join(5.0)
+    stop.set()
+    assert not thread.is_alive()
@@ -1,15 +1,24 @@
 import moderngl_window as mlgw
 from time import perf_counter
 import git
-from zmq_relay import Relay
+from zmq_relay import Relay, OfflineRelay, Publisher, backends
+from decoders import decoders
+from zmq_log import ReplaySource
 from moderngl_window.integrations.imgui import ModernglWindowRenderer
 import time
 from datetime import datetime
 from dateutil import tz
-from audio_fbk import AudioServer
+from audio_fbk import AudioServer, FeedbackBank
+from audio_process import AudioProcess
+from audio_utils import AudioAnalysis
 from pathlib import Path
-from shader_ui import ComboList
+from shader_ui import ComboList, ParamRegistry
+from profiler import FrameProfiler, RingStats
+from shader_manager import ShaderManager
+from frame_data import FrameData
+from capture import FrameCapture, formats as capture_formats
 import imgui
+import json
 
 
 def iso_now():
@@ -22,32 +31,71 @@ class WindowEvents(mlgw.WindowConfig):
     author = "OVERRIDE author"
     resource_dir = (Path(__file__).parent).resolve()
     aspect_ratio = None
+    # texture unit reserved for the audio spectrum
+    spectrum_unit = 7
 
     def close(self):
+        self.shader_manager.close()
+        if self.capture is not None:
+            print(self.capture.close())
         self.relay.close()
+        if self.replay is not None:
+            self.replay.close()
+        if self.publisher is not None:
+            self.publisher.close()
         time.sleep(0.1)
         self.audio_server.close()
         time.sleep(0.1)
         exit()
 
     def load_shaders(self):
-        # load all of the shaders into a dictionary
-        self.shaders = {}
-        for shader, path in self.shader_paths.items():
-            print(path)
-            self.shaders[shader] = self.load_program(path)
+        # load all of the shaders into a dictionary, recompiling and
+        # swapping in any that change on disk (see update())
+        self.shader_manager = ShaderManager(
+            self.ctx,
+            self.shader_paths,
+            self.compute_shader_paths,
+            getattr(self, "compute_shader_defines", {}),
+            root=self.resource_dir,
+        )
+        self.shaders = self.shader_manager.shaders
+        for program in self.shaders.values():
+            self.bind_program(program)
+        self.shader_manager.on_swap.append(lambda old, new: self.bind_program(new))
+        self.shader_manager.on_swap.append(self.params.rebind)
+        if self.argv.shader_watch:
+            self.shader_manager.watch()
+
+    def bind_program(self, program):
+        """Set up a newly loaded program: attach the FrameData block
+        and the spectrum texture unit, which never change per frame"""
+        self.frame_data.bind(program)
+        if "audio_spectrum" in program:
+            program["audio_spectrum"] = self.spectrum_unit
+
+    def preset(self):
+        """Every visual and audio parameter, as one dict"""
+        return {"visual": self.params.preset(), "audio": self.feedback_bank.preset()}
+
+    def save_preset(self, path=None):
+        with open(path or self.argv.preset, "w") as f:
+            json.dump(self.preset(), f, indent=2)
 
-        for shader, path in self.compute_shader_paths.items():
-            self.shaders[shader] = self.load_compute_shader(path)
+    def load_preset(self, path=None):
+        """Apply a saved preset; values are pushed on the next update()"""
+        path = Path(path or self.argv.preset)
+        if not path.exists():
+            return False
+        with open(path) as f:
+            preset = json.load(f)
+        self.params.apply(preset.get("visual", {}))
+        self.feedback_bank.apply(preset.get("audio", {}))
+        return True
 
     def set_feedback(self, fbk):
-        """Set the feedback type to the given value"""
-        if self.audio is not None:
-            del self.audio
-        self.audio_server.stop()
-        time.sleep(0.05)
-        self.audio_server.start()
-        self.audio = fbk(self.audio_server)
+        """Crossfade to the given feedback type. Graphs are cached,
+        so the server keeps running and nothing is rebuilt"""
+        self.audio = self.feedback_bank.set(fbk)
 
     @classmethod
     def add_arguments(self, parser):
@@ -59,6 +107,16 @@ class WindowEvents(mlgw.WindowConfig):
             default=5556,
             help="Set the port to listen on for incoming ZMQ messages",
         )
+        parser.add_argument(
+            "--endpoint",
+            action="append",
+            help="ZMQ endpoint to connect to (may be repeated, overrides --port)",
+        )
+        parser.add_argument(
+            "--topic",
+            action="append",
+            help="ZMQ topic to subscribe to (may be repeated, default demo)",
+        )
         parser.add_argument(
             "--audio",
             "-a",
@@ -77,6 +135,122 @@ class WindowEvents(mlgw.WindowConfig):
             default="pa",
             help="Set the server to use (portaudio, jack or coreaudio)",
         )
+        parser.add_argument("--sr", type=int, default=44100, help="Audio sample rate")
+        parser.add_argument(
+            "--buffersize",
+            type=int,
+            default=256,
+            help="Audio block size in samples (latency is buffersize / sr)",
+        )
+        parser.add_argument(
+            "--duplex",
+            type=int,
+            default=1,
+            choices=[0, 1],
+            help="Open the audio input as well as the output",
+        )
+        parser.add_argument(
+            "--audio_stats",
+            action="store_true",
+            help="Measure audio block timing, DSP load and underruns",
+        )
+        parser.add_argument(
+            "--audio_process",
+            action="store_true",
+            help="Run the audio server and feedbacks in a separate process",
+        )
+        parser.add_argument(
+            "--prebuild_audio",
+            action="store_true",
+            help="Build every audio feedback graph at startup, not on first use",
+        )
+        parser.add_argument(
+            "--relay_backend",
+            default="process",
+            choices=backends,
+            help="Run the ZMQ relay in a process, a thread or an asyncio task",
+        )
+        parser.add_argument(
+            "--relay_decoder",
+            default="json",
+            choices=list(decoders),
+            help="Decode incoming ZMQ payloads in the relay",
+        )
+        parser.add_argument(
+            "--relay_coalesce",
+            default="latest",
+            choices=["none", "latest"],
+            help="Merge all packets received in a frame into one latest-value dict",
+        )
+        parser.add_argument(
+            "--record",
+            default=None,
+            help="Record all incoming ZMQ messages to this log file",
+        )
+        parser.add_argument(
+            "--replay",
+            default=None,
+            help="Replay a recorded ZMQ log into the relay instead of live input",
+        )
+        parser.add_argument(
+            "--replay_speed",
+            type=float,
+            default=1.0,
+            help="Replay speed multiplier (0 replays as fast as possible)",
+        )
+        parser.add_argument(
+            "--publish",
+            default=None,
+            help="Publish demo state on this ZMQ address (e.g. tcp://*:5557)",
+        )
+        parser.add_argument(
+            "--publish_decimate",
+            type=int,
+            default=1,
+            help="Only publish state every N frames",
+        )
+        parser.add_argument(
+            "--preset",
+            default="preset.json",
+            help="Visual and audio parameter preset to load and save",
+        )
+        parser.add_argument(
+            "--shader_watch",
+            type=int,
+            default=1,
+            choices=[0, 1],
+            help="Recompile shaders when their files change",
+        )
+        parser.add_argument(
+            "--capture",
+            default=None,
+            help="Capture every rendered frame to this directory (png, raw) "
+            "or video file (ffmpeg)",
+        )
+        parser.add_argument(
+            "--capture_format",
+            default="png",
+            choices=capture_formats,
+            help="Write captured frames as PNGs, raw frames or through ffmpeg",
+        )
+        parser.add_argument(
+            "--bench_frames",
+            type=int,
+            default=0,
+            help="Render this many frames, print frame timings and exit "
+            "(use with --window headless --backend egl for no display)",
+        )
+        parser.add_argument(
+            "--bench_warmup",
+            type=int,
+            default=30,
+            help="Frames to render before benchmark timing starts",
+        )
+        parser.add_argument(
+            "--bench_json",
+            default=None,
+            help="Also write the benchmark results to this JSON file",
+        )
 
     def init_git(self):
         # get current git details
@@ -94,20 +268,99 @@ class WindowEvents(mlgw.WindowConfig):
         self.imgui = ModernglWindowRenderer(self.wnd)
 
     def init_audio(self):
-        self.audio_server = AudioServer(
-            audio=True, device=int(self.argv.device), server=self.argv.audio_server
+        settings = dict(
+            # headless: no device, blocks are only computed on request
+            audio="manual" if self.headless else True,
+            device=int(self.argv.device),
+            server=self.argv.audio_server,
+            sr=self.argv.sr,
+            buffersize=self.argv.buffersize,
+            duplex=self.argv.duplex,
+            instrument=self.argv.audio_stats,
         )
+        if self.headless:
+            settings["startup_sound"] = False
         self.audio_feedbacks = ComboList(self.audio_feedback_map)
+        self.analysis = None
+        if self.argv.audio_process:
+            # same API, but the graphs run in a child process
+            # (no analysis feed: it lives in the parent's audio thread)
+            self.audio_server = AudioProcess(self.audio_feedback_map, **settings)
+            self.feedback_bank = self.audio_server.bank
+        else:
+            self.audio_server = AudioServer(**settings)
+            self.analysis = AudioAnalysis()
+            self.audio_server.add_callback(self.analysis.callback)
+            self.feedback_bank = FeedbackBank(
+                self.audio_server,
+                self.audio_feedback_map,
+                prebuild=self.argv.prebuild_audio,
+                analysis=self.analysis,
+            )
+        self.init_analysis_texture()
 
         self.audio = None
         # use command line arg for initial connection
         self.set_feedback(self.audio_feedbacks.dict[self.argv.audio])
 
+    def init_analysis_texture(self):
+        """Spectrum texture (n_bins x 1, one float per bin), sampled
+        by shaders as audio_spectrum, with audio_rms/audio_peak uniforms"""
+        n_bins = self.analysis.n_bins if self.analysis is not None else 1
+        self.spectrum_texture = self.ctx.texture((n_bins, 1), 1, dtype="f4")
+        self.spectrum_texture.repeat_x = False
+        self.analysis_seq = -1
+        self.audio_levels = (0.0, 0.0)
+
+    def update_analysis(self):
+        """Upload the latest audio analysis, if it has changed"""
+        if self.analysis is None:
+            return
+        seq, data = self.analysis.read()
+        if seq == self.analysis_seq:
+            return
+        self.analysis_seq = seq
+        self.spectrum_texture.write(data[: self.analysis.n_bins])
+        self.audio_levels = (float(data[-2]), float(data[-1]))
+
     def init_zmq(self):
-        self.relay = Relay()
+        self.replay = None
+        if self.argv.replay:
+            # publish the recording where the relay will connect
+            self.replay = ReplaySource(
+                self.argv.replay,
+                address=f"tcp://127.0.0.1:{self.argv.port}",
+                speed=self.argv.replay_speed,
+                loop=True,
+            )
+        coalesce = self.argv.relay_coalesce
+        if self.headless and self.replay is None and not self.argv.record:
+            # no live input (and no relay process) without a display,
+            # unless it is being recorded
+            self.relay = OfflineRelay()
+        else:
+            self.relay = Relay(
+                port=int(self.argv.port),
+                endpoints=self.argv.endpoint,
+                topics=self.argv.topic or ["demo"],
+                backend=self.argv.relay_backend,
+                decoder=decoders[self.argv.relay_decoder](),
+                coalesce=None if coalesce == "none" else coalesce,
+                record=self.argv.record,
+            )
+        self.publisher = None
+        if self.argv.publish:
+            self.publisher = Publisher(
+                self.argv.publish, decimate=self.argv.publish_decimate
+            )
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
+        self.headless = self.wnd.name == "headless"
+        # set up by init_capture, if --capture is given
+        self.capture = None
+        # tunable parameters (e.g. shader sliders), pushed once per frame
+        self.params = ParamRegistry()
         # self.monitor = Monitor()
         # self.monitor.clear_flag("ZMQ")
 
@@ -116,8 +369,83 @@ class WindowEvents(mlgw.WindowConfig):
         self.init_zmq()
         self.init_gui()
         self.init_t = perf_counter()
+        # time, camera, resolution and audio levels for every shader
+        self.frame_data = FrameData(self.ctx)
         self.alive = False
         self.init_fonts()
+        # per-pass GPU/CPU timings
+        self.profiler = FrameProfiler(self.ctx)
+        self.bench_count = 0
+        self.bench_times = RingStats(max(self.argv.bench_frames, 1))
+        self.bench_start = self.bench_last = None
+
+    def init_capture(self, texture):
+        """Capture texture every frame, if --capture was given"""
+        if self.argv.capture:
+            self.capture = FrameCapture(
+                self.ctx,
+                texture.size,
+                self.argv.capture,
+                self.argv.capture_format,
+                components=texture.components,
+                git=self.git,
+            )
+
+    def bench_frame(self):
+        """Count a rendered frame; with --bench_frames, time frames
+        after the warmup and report (and exit) once enough are done"""
+        if not self.argv.bench_frames:
+            return
+        # wait for the GPU, so each frame is timed in full
+        self.ctx.finish()
+        now = perf_counter()
+        self.bench_count += 1
+        if self.bench_count > max(self.argv.bench_warmup, 1):
+            self.bench_times.add((now - self.bench_last) * 1000.0)
+        else:
+            self.bench_start = now
+            self.profiler.reset()
+        self.bench_last = now
+        if self.bench_times.count >= self.argv.bench_frames:
+            self.bench_report()
+            self.close()
+
+    def render_info(self):
+        """Anything else a benchmark should report about what was
+        rendered (e.g. the offscreen render size)"""
+        return {}
+
+    def bench_report(self):
+        frames = self.bench_times.count
+        elapsed = self.bench_last - self.bench_start
+        info = self.render_info()
+        results = {
+            "renderer": self.ctx.info["GL_RENDERER"],
+            "size": list(self.wnd.size),
+            **info,
+            "frames": frames,
+            "fps": frames / elapsed,
+            "frame_ms": self.bench_times.summary(),
+            "passes": self.profiler.summary(),
+        }
+        print(
+            f"{results['renderer']}: {frames} frames in {elapsed:.2f}s, "
+            f"{results['fps']:.1f} fps"
+        )
+        for key, value in info.items():
+            print(f"{key}: {value}")
+        for name, stats in [("total", {"cpu": results["frame_ms"]})] + list(
+            results["passes"].items()
+        ):
+            for kind, s in stats.items():
+                print(
+                    f"{name:>8} {kind}: mean {s['mean']:.2f}ms p50 {s['p50']:.2f}ms "
+                    f"p95 {s['p95']:.2f}ms p99 {s['p99']:.2f}ms max {s['max']:.2f}ms"
+                )
+        if self.argv.bench_json:
+            with open(self.argv.bench_json, "w") as f:
+                json.dump(results, f, indent=2, default=float)
+        return results
 
     def init_fonts(self):
         io = imgui.get_io()
@@ -130,22 +458,30 @@ class WindowEvents(mlgw.WindowConfig):
         # self.monitor.watch("time", time)
         # self.monitor.set_fps(1.0 / (frame_time + 1e-6))
         # self.monitor.update()
-        msg = self.relay.poll()
-        if msg:
-            msgs = [msg]
-        else:
-            msgs = []
-        while msg:
-            self.audio.ping()
-            msg = self.relay.poll()
-            if msg:
-                msgs.append(msg)
+        # swap in any reloaded shaders before anything uses them
+        self.shader_manager.update()
+        self.params.update(frame_time)
+        self.feedback_bank.update()
+        msgs = self.relay.drain_all()
+        for topic, packets in msgs.items():
+            if not packets:
+                continue
+            if self.relay.topics[topic].coalescer is not None:
+                # one merged (count, value) batch per frame
+                count, value = packets[0]
+                self.audio.events(count, value)
+            else:
+                # one trigger per packet
+                for packet in packets:
+                    self.audio.events(1, packet)
+
+        self.update_analysis()
+        self.spectrum_texture.use(location=self.spectrum_unit)
+        rms, peak = self.audio_levels
 
+        # one upload shared by every shader
         t = perf_counter() - self.init_t
-        # copy time into every shader
-        for shader in self.shaders.values():
-            if "iTime" in shader:
-                shader["iTime"] = t
+        self.frame_data.update(t, rms, peak)
 
         return msgs
 
@@ -0,0 +1,194 @@
+import mmap
+import queue
+import struct
+import threading
+import time
+import zmq
+
+# Append-only log of multipart ZMQ messages:
+#   magic, then for each message
+#   (t_ns: int64, n_frames: uint32), then n_frames x (length: uint32, bytes)
+# t_ns is the perf_counter_ns() receive time, so only differences matter.
+magic = b"ZMQLOG01"
+record = struct.Struct("<qI")
+length = struct.Struct("<I")
+
+
+class LogWriter:
+    """Append multipart messages to a log file from a background
+    thread, so recording never blocks the relay loop"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "wb", buffering=1 << 20)
+        self.file.write(magic)
+        self.queue = queue.SimpleQueue()
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def write(self, frames, t_ns=None):
+        """Queue a message (a list of zmq Frames or buffers)"""
+        if t_ns is None:
+            t_ns = time.perf_counter_ns()
+        self.queue.put((t_ns, frames))
+
+    def _run(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                break
+            t_ns, frames = item
+            self.file.write(record.pack(t_ns, len(frames)))
+            for frame in frames:
+                buf = memoryview(getattr(frame, "buffer", frame))
+                self.file.write(length.pack(buf.nbytes))
+                self.file.write(buf)
+        self.file.close()
+
+    def close(self):
+        self.queue.put(None)
+        self.thread.join()
+
+
+class LogReader:
+    """Read a message log through a memory map. Iterating yields
+    (t_ns, frames), where frames are memoryviews into the map,
+    valid until the reader is closed"""
+
+    def __init__(self, path):
+        self.path = path
+        self.file = open(path, "rb")
+        self.map = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        if self.map[: len(magic)] != magic:
+            raise ValueError(f"{path} is not a ZMQ message log")
+        self.view = memoryview(self.map)
+
+    def __iter__(self):
+        view = self.view
+        end = len(view)
+        offset = len(magic)
+        while offset + record.size <= end:
+            t_ns, n_frames = record.unpack_from(view, offset)
+            at = offset + record.size
+            frames = []
+            for i in range(n_frames):
+                if at + length.size > end:
+                    return
+                (n,) = length.unpack_from(view, at)
+                at += length.size
+                frames.append(view[at : at + n])
+                at += n
+            if at > end:
+                # truncated final record (recording was killed)
+                return
+            offset = at
+            yield t_ns, frames
+
+    def info(self):
+        """Return (messages, duration in seconds, {topic: count})"""
+        count, first, last, topics = 0, None, None, {}
+        for t_ns, frames in self:
+            first = t_ns if first is None else first
+            last = t_ns
+            count += 1
+            topic = bytes(frames[0]).decode("utf8", "replace")
+            topics[topic] = topics.get(topic, 0) + 1
+        duration = 0.0 if first is None else (last - first) / 1e9
+        return count, duration, topics
+
+    def close(self):
+        self.view.release()
+        try:
+            self.map.close()
+        except BufferError:
+            # frames still referenced elsewhere
+            pass
+        self.file.close()
+
+
+def replay(path, address, stop, speed=1.0, loop=False):
+    """Publish a recorded log on address. speed=1 replays in real
+    time, speed=N at N x real time and speed=0 as fast as possible"""
+    ctx = zmq.Context()
+    sock = ctx.socket(zmq.PUB)
+    sock.setsockopt(zmq.LINGER, 0)
+    sock.setsockopt(zmq.SNDHWM, 0)
+    sock.bind(address)
+    # give subscribers time to connect
+    time.sleep(0.5)
+    reader = LogReader(path)
+    sent = 0
+    try:
+        while not stop.is_set():
+            start = time.perf_counter_ns()
+            first = None
+            for t_ns, frames in reader:
+                if stop.is_set():
+                    break
+                first = t_ns if first is None else first
+                if speed > 0:
+                    due = start + (t_ns - first) / speed
+                    delay = (due - time.perf_counter_ns()) / 1e9
+                    if delay > 0:
+                        stop.wait(delay)
+                sock.send_multipart(frames)
+                sent += 1
+            if not loop or first is None:
+                # (an empty log would otherwise loop flat out)
+                break
+    finally:
+        reader.close()
+        sock.close()
+        ctx.term()
+    return sent
+
+
+class ReplaySource:
+    """Replay a recorded log into a Relay by publishing it in
+    a background thread on the address the relay connects to"""
+
+    def __init__(self, path, address="tcp://127.0.0.1:5556", speed=1.0, loop=False):
+        self.path = path
+        self.address = address
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(
+            target=replay,
+            args=(path, address, self.stop_event),
+            kwargs={"speed": speed, "loop": loop},
+            daemon=True,
+        )
+        self.thread.start()
+
+    def running(self):
+        return self.thread.is_alive()
+
+    def close(self, timeout=1.0):
+        self.stop_event.set()
+        self.thread.join(timeout)
+
+
+if __name__ == "__main__":
+    import argparse
+
+    parser = argparse.ArgumentParser(description="Inspect or replay ZMQ message logs")
+    parser.add_argument("mode", choices=["info", "replay"])
+    parser.add_argument("path")
+    parser.add_argument("--address", default="tcp://127.0.0.1:5556")
+    parser.add_argument(
+        "--speed", type=float, default=1.0, help="Replay speed, 0 for flat out"
+    )
+    parser.add_argument("--loop", action="store_true")
+    args = parser.parse_args()
+
+    if args.mode == "info":
+        reader = LogReader(args.path)
+        count, duration, topics = reader.info()
+        reader.close()
+        print(f"{count} messages over {duration:.2f}s")
+        for topic, n in topics.items():
+            print(f"\t{topic}: {n}")
+    else:
+        t = time.perf_counter()
+        sent = replay(args.path, args.address, threading.Event(), args.speed, args.loop)
+        elapsed = time.perf_counter() - t
+        print(f"Replayed {sent} messages in {elapsed:.2f}s ({sent/elapsed:.0f}/s)")
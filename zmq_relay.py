@@ -1,78 +1,691 @@
 import time
+import json
+import struct
+import asyncio
+import threading
+import multiprocessing
 from datetime import datetime, timedelta
-from multiprocessing import Process, Queue
+from multiprocessing import Process
+import numpy as np
 import zmq
+import zmq.asyncio
+from shm_ring import ShmRing
+from decoders import Coalescer, Decoder
+from zmq_log import LogWriter
 
+backends = ("process", "thread", "asyncio")
 
-def zmq_server(out_q, ctrl_q, topic="demo", ip="127.0.0.1", port=5556):
-    stopped = False
+
+class Topic:
+    """Subscription to one topic. Each topic has its own SUB
+    socket connected to all of its endpoints (so HWM and receive
+    buffer sizes are per topic), its own ring buffer and its own
+    decoder/coalescing stage.
+
+    On every pass of the relay loop, topics are read in priority
+    order (highest first), each at most `budget` packets, so a
+    high-rate topic cannot starve a low-rate one.
+
+    conflate=True keeps only the latest packet in the relay, and
+    drain() returns a single (count, latest) pair. (ZMQ_CONFLATE
+    itself drops multipart messages, so cannot be used with
+    [topic, payload] packets; pass it via options for single-part
+    publishers.)"""
+
+    def __init__(
+        self,
+        name,
+        endpoints=None,
+        priority=0,
+        hwm=1000,
+        rcvbuf=-1,
+        options=None,
+        conflate=False,
+        decoder=None,
+        coalesce=None,
+        n_slots=2048,
+        slot_size=8192,
+        policy="drop_oldest",
+    ):
+        self.name = name
+        self.endpoints = endpoints or []
+        self.priority = priority
+        self.hwm = hwm
+        self.rcvbuf = rcvbuf
+        self.options = options or {}
+        self.decoder = decoder
+        if conflate:
+            coalesce = "conflate"
+        self.coalescer = None
+        if coalesce is not None:
+            self.coalescer = Coalescer(decoder or Decoder(), coalesce)
+        self.ring = ShmRing(n_slots=n_slots, slot_size=slot_size, policy=policy)
+
+    def open(self, ctx):
+        """Create and connect the SUB socket (relay worker side)"""
+        sock = ctx.socket(zmq.SUB)
+        # never hang on close waiting for undelivered messages
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.setsockopt(zmq.RCVHWM, self.hwm)
+        if self.rcvbuf > 0:
+            sock.setsockopt(zmq.RCVBUF, self.rcvbuf)
+        for option, value in self.options.items():
+            sock.setsockopt(option, value)
+        for endpoint in self.endpoints:
+            sock.connect(endpoint)
+        sock.setsockopt(zmq.SUBSCRIBE, self.name.encode("utf8"))
+        return sock
+
+    def receive(self, msg):
+        # either copy the raw payload into the ring, or decode
+        # and merge it into the pending batch
+        if self.coalescer is None:
+            self.ring.put(msg.buffer)
+            return
+        try:
+            self.coalescer.add(msg.buffer, self.ring)
+        except Exception:
+            # one malformed packet must not kill the relay worker
+            self.ring.count_bad()
+
+    def flush(self):
+        if self.coalescer is not None:
+            self.coalescer.flush(self.ring)
+
+    def drain(self, max_items=None):
+        """Host side: return waiting packets, see Relay.drain()"""
+        msgs = self.ring.drain(max_items)
+        if self.coalescer is not None:
+            try:
+                batch = self.coalescer.unpack(msgs)
+            except Exception:
+                self.ring.count_bad(len(msgs), consumer=True)
+                return []
+            return [] if batch is None else [batch]
+        if self.decoder is not None:
+            values = []
+            for msg in msgs:
+                try:
+                    values.append(self.decoder.decode(msg))
+                except Exception:
+                    self.ring.count_bad(consumer=True)
+            return values
+        return msgs
+
+
+def zmq_server(topics, stop, poll_ms=10, budget=256, record=None):
+    """Blocking relay loop, used by the thread and process backends.
+    Waits at most poll_ms for packets before checking the stop event.
+    If record is a path, every message is also logged there"""
     ctx = zmq.Context()
-    sock = ctx.socket(zmq.SUB)
-    sock.connect(f"tcp://{ip}:{port}")
-    sock.setsockopt(zmq.SUBSCRIBE, topic.encode("utf8"))
-    
-    while True:        
-        if not ctrl_q.empty():
-            msg = ctrl_q.get_nowait()
-            if msg == "stop":
-                print("STOPPING")
-                break        
-        topic, msg = sock.recv_multipart()        
-        out_q.put(msg)
+    socks = [(topic.open(ctx), topic) for topic in topics]
+    poller = zmq.Poller()
+    for sock, topic in socks:
+        poller.register(sock, zmq.POLLIN)
+    writer = LogWriter(record) if record else None
+    try:
+        while not stop.is_set():
+            ready = dict(poller.poll(poll_ms))
+            for sock, topic in socks:
+                if sock not in ready:
+                    continue
+                for i in range(budget):
+                    try:
+                        frames = sock.recv_multipart(zmq.NOBLOCK, copy=False)
+                    except zmq.Again:
+                        break
+                    topic.receive(frames[-1])
+                    if writer is not None:
+                        writer.write(frames)
+            for topic in topics:
+                topic.flush()
+    finally:
+        for sock, topic in socks:
+            sock.close()
+        ctx.term()
+        if writer is not None:
+            writer.close()
+
+
+async def zmq_server_async(topics, stop, poll_ms=10, budget=256, record=None):
+    """Relay loop as an asyncio task"""
+    ctx = zmq.asyncio.Context()
+    socks = [(topic.open(ctx), topic) for topic in topics]
+    poller = zmq.asyncio.Poller()
+    for sock, topic in socks:
+        poller.register(sock, zmq.POLLIN)
+    writer = LogWriter(record) if record else None
+    try:
+        while not stop.is_set():
+            ready = dict(await poller.poll(poll_ms))
+            for sock, topic in socks:
+                if sock not in ready:
+                    continue
+                for i in range(budget):
+                    if not sock.getsockopt(zmq.EVENTS) & zmq.POLLIN:
+                        break
+                    frames = await sock.recv_multipart(copy=False)
+                    topic.receive(frames[-1])
+                    if writer is not None:
+                        writer.write(frames)
+            for topic in topics:
+                topic.flush()
+    finally:
+        for sock, topic in socks:
+            sock.close()
+        ctx.term()
+        if writer is not None:
+            writer.close()
 
 
 class Relay:
     """Relay ZMQ packets to the host, always
     returning new packets by running the poll
-    loop in a separate process"""
+    loop in the background. Packets are handed
+    over through shared memory ring buffers, one
+    per topic.
+
+    The loop runs in a separate process (backend="process"),
+    a thread in this process (backend="thread") or as an
+    asyncio task (backend="asyncio"), either on the given
+    loop or on a private loop in its own thread.
+
+    topics is a list of Topic objects, or of topic names, which
+    use the ring, decoder and coalescing settings given here.
+    Topics without their own endpoints connect to all of
+    `endpoints` (by default, tcp://ip:port).
+
+    With a decoder, drain() returns decoded packets. With
+    coalesce="latest" or "stack", packets are decoded and merged
+    in the worker, and drain() returns at most one (count, value)
+    pair per call: a dict of the latest value for each key, or
+    a stacked numpy array of fixed-layout records.
 
-    def __init__(self, ip="127.0.0.1", port=5556):
+    With record=path, every received message is appended to a
+    message log (see zmq_log), which ReplaySource can play back."""
+
+    def __init__(
+        self,
+        ip="127.0.0.1",
+        port=5556,
+        topics=("demo",),
+        endpoints=None,
+        backend="process",
+        loop=None,
+        poll_ms=10,
+        budget=256,
+        n_slots=2048,
+        slot_size=8192,
+        policy="drop_oldest",
+        decoder=None,
+        coalesce=None,
+        record=None,
+    ):
+        if backend not in backends:
+            raise ValueError(
+                f"Unknown relay backend {backend}, expected one of {backends}"
+            )
         self.port = port
         self.ip = ip
+        self.backend = backend
         self.last_live = datetime.now() - timedelta(days=1)
-        self.in_q = Queue()
-        self.ctrl_q = Queue()
-        self.address = f"{self.ip}:{self.port}"
-        self.process = Process(
-            target=zmq_server,
-            args=(self.in_q, self.ctrl_q),
-            kwargs={"port": port, "ip": ip},
-        )
-        self.process.start()
+        self.endpoints = endpoints or [f"tcp://{ip}:{port}"]
+        self.address = ", ".join(self.endpoints)
+
+        self.topics = {}
+        for topic in topics:
+            if isinstance(topic, str):
+                topic = Topic(
+                    topic,
+                    decoder=decoder,
+                    coalesce=coalesce,
+                    n_slots=n_slots,
+                    slot_size=slot_size,
+                    policy=policy,
+                )
+            topic.endpoints = topic.endpoints or self.endpoints
+            self.topics[topic.name] = topic
+        # drain() with no topic reads the first one given
+        self.default_topic = next(iter(self.topics))
+        self.topics = dict(sorted(self.topics.items(), key=lambda kv: -kv[1].priority))
+
+        args = (list(self.topics.values()),)
+        kwargs = {"poll_ms": poll_ms, "budget": budget, "record": record}
+        self.future = None
 
-    def poll(self):
-        if self.in_q.empty():
+        if backend == "process":
+            self.stop_event = multiprocessing.Event()
+            self.worker = Process(
+                target=zmq_server,
+                args=args + (self.stop_event,),
+                kwargs=kwargs,
+                daemon=True,
+            )
+        elif backend == "thread":
+            self.stop_event = threading.Event()
+            self.worker = threading.Thread(
+                target=zmq_server,
+                args=args + (self.stop_event,),
+                kwargs=kwargs,
+                daemon=True,
+            )
+        else:
+            self.stop_event = threading.Event()
+            task = zmq_server_async(*args, self.stop_event, **kwargs)
+            if loop is None:
+                self.worker = threading.Thread(
+                    target=asyncio.run, args=(task,), daemon=True
+                )
+            else:
+                # loop must be running in another thread
+                self.worker = None
+                self.future = asyncio.run_coroutine_threadsafe(task, loop)
+
+        if self.worker is not None:
+            self.worker.start()
+
+    def drain(self, max_items=None, topic=None):
+        """Return all waiting packets (at most max_items) for a topic
+        as a list. Undecoded packets are bytes, or with the "block"
+        policy memoryviews onto the shared ring that are only valid
+        until the next call to drain() or poll()"""
+        msgs = self.topics[topic or self.default_topic].drain(max_items)
+        if msgs:
+            self.last_live = datetime.now()
+        return msgs
+
+    def drain_all(self, max_items=None):
+        """Drain every topic, returning {topic: packets}
+        in priority order"""
+        return {name: self.drain(max_items, name) for name in self.topics}
+
+    def poll(self, topic=None):
+        """Return the next packet (as bytes if not decoded), or None"""
+        msgs = self.drain(1, topic)
+        if not msgs:
             return None
-        self.last_live = datetime.now()
-        msg = self.in_q.get()        
-        return msg
+        msg = msgs[0]
+        return bytes(msg) if isinstance(msg, memoryview) else msg
+
+    def stats(self):
+        """Return the ring buffer counters (total, pending,
+        dropped, oversize, blocked, and bad: packets that failed
+        to decode) for each topic"""
+        return {name: topic.ring.stats() for name, topic in self.topics.items()}
 
     def live(self):
         """Return True if the data is fresh (i.e.
         poll successful within 5 seconds)"""
         return (datetime.now() - self.last_live).total_seconds() < 5.0
 
-    def close(self):
-        self.ctrl_q.put("stop")
-        time.sleep(0.5)
-        self.process.terminate()
+    def close(self, timeout=1.0):
+        """Stop the relay loop and release the rings. The loop
+        sees the stop event within poll_ms"""
+        self.stop_event.set()
+        if self.future is not None:
+            self.future.result(timeout)
+        else:
+            self.worker.join(timeout)
+            if self.backend == "process" and self.worker.is_alive():
+                self.worker.terminate()
+        for topic in self.topics.values():
+            topic.ring.close()
 
 
-if __name__ == "__main__":
-    import json
+class OfflineRelay:
+    """Stand-in for a Relay with no ZMQ input at all (headless
+    benchmarks): never live, and every drain is empty"""
+
+    def __init__(self):
+        self.address = "offline"
+        self.topics = {}
+
+    def drain(self, max_items=None, topic=None):
+        return []
+
+    def drain_all(self, max_items=None):
+        return {}
+
+    def poll(self, topic=None):
+        return None
+
+    def stats(self):
+        return {}
+
+    def live(self):
+        return False
+
+    def close(self, timeout=1.0):
+        pass
+
+
+class _Sending:
+    """Tracker stand-in for an array the sender thread has taken"""
+
+    done = False
+
 
-    topic = "demo".encode("utf8")
-    address = "tcp://127.0.0.1:5556"
+_sending = _Sending()
 
+
+class Publisher:
+    """Publish numpy arrays (simulation and audio state) on a PUB
+    socket from a background thread.
+
+    Each array goes out as [topic, header, data], where header is
+    JSON giving dtype, shape and frame number, and data is sent
+    zero-copy. To avoid copying twice, fill an array obtained from
+    acquire() (e.g. with buffer.read_into()) and pass it to publish().
+    Buffers are reused only once ZMQ has finished sending them.
+
+    Only every `decimate`-th frame of each topic is published, and
+    a topic's unsent array is replaced by a newer one, so a slow
+    network never backs up into the render loop."""
+
+    def __init__(self, address="tcp://127.0.0.1:5557", decimate=1, n_buffers=3):
+        self.address = address
+        self.decimate = decimate
+        self.n_buffers = n_buffers
+        self.frames = {}
+        self.pools = {}
+        self.pending = {}
+        self.sent = 0
+        self.skipped = 0
+        self.cond = threading.Condition()
+        self.stopped = False
+        # the socket lives in (and is only touched by) the sender thread
+        self.thread = threading.Thread(target=self._run, daemon=True)
+        self.thread.start()
+
+    def due(self, topic):
+        """Whether the next acquire() for topic falls on a
+        published (not decimated) frame"""
+        return self.frames.get(topic, 0) % self.decimate == 0
+
+    def acquire(self, topic, shape, dtype=np.float32):
+        """Return a free array to fill for this topic, or None if this
+        frame is decimated away or every buffer is still in flight"""
+        due = self.due(topic)
+        self.frames[topic] = self.frames.get(topic, 0) + 1
+        if not due:
+            return None
+        pool = self.pools.setdefault(topic, [])
+        with self.cond:
+            queued = self.pending.get(topic)
+            for slot in pool:
+                array, tracker = slot
+                if array.shape != tuple(shape) or array.dtype != np.dtype(dtype):
+                    continue
+                if queued is not None and queued[0] is array:
+                    continue
+                if tracker is None or tracker.done:
+                    return array
+        if len(pool) < self.n_buffers:
+            array = np.empty(shape, dtype)
+            pool.append([array, None])
+            return array
+        self.skipped += 1
+        return None
+
+    def publish(self, topic, array, lag=0):
+        """Queue an array for sending, replacing any unsent
+        array for the same topic. lag is how many frames old
+        the data is (e.g. when read back asynchronously)"""
+        header = {
+            "dtype": array.dtype.str,
+            "shape": array.shape,
+            "frame": self.frames.get(topic, 1) - 1 - lag,
+            "t_ns": time.perf_counter_ns(),
+        }
+        with self.cond:
+            if topic in self.pending:
+                self.skipped += 1
+            self.pending[topic] = (array, json.dumps(header).encode("utf8"))
+            self.cond.notify()
+
+    def _track(self, topic, array, tracker):
+        for slot in self.pools.get(topic, []):
+            if slot[0] is array:
+                slot[1] = tracker
+
+    def _run(self):
+        ctx = zmq.Context()
+        sock = ctx.socket(zmq.PUB)
+        sock.setsockopt(zmq.LINGER, 0)
+        sock.bind(self.address)
+        try:
+            while True:
+                with self.cond:
+                    while not self.pending and not self.stopped:
+                        self.cond.wait()
+                    if self.stopped:
+                        break
+                    pending, self.pending = self.pending, {}
+                    # busy until the real tracker replaces it, so
+                    # acquire() cannot hand it out mid-send
+                    for topic, (array, header) in pending.items():
+                        self._track(topic, array, _sending)
+                for topic, (array, header) in pending.items():
+                    tracker = sock.send_multipart(
+                        [topic.encode("utf8"), header, array],
+                        copy=False,
+                        track=True,
+                    )
+                    with self.cond:
+                        self._track(topic, array, tracker)
+                    self.sent += 1
+        finally:
+            sock.close()
+            ctx.term()
+
+    def close(self, timeout=1.0):
+        with self.cond:
+            self.stopped = True
+            self.cond.notify()
+        self.thread.join(timeout)
+
+
+def read_array(frames):
+    """Turn a [topic, header, data] message from a Publisher
+    back into (header, array), without copying the data"""
+    header = json.loads(bytes(frames[1]))
+    array = np.frombuffer(frames[2], header["dtype"]).reshape(header["shape"])
+    return header, array
+
+
+# load generator packets start with (sequence number, send time in ns);
+# sequence numbers count per topic, so loss can be measured on any
+# subset of the topics published
+stamp = struct.Struct("<QQ")
+
+
+def make_packet(seq, size=0, format="raw"):
+    """Build a timestamped test packet of (at least) size bytes"""
+    t = time.perf_counter_ns()
+    if format == "json":
+        msg = {"message_id": seq, "t_ns": t}
+        pad = size - len(json.dumps(msg)) - 10
+        if pad > 0:
+            msg["pad"] = "x" * pad
+        return json.dumps(msg).encode("utf8")
+    return stamp.pack(seq, t) + bytes(max(0, size - stamp.size))
+
+
+def read_stamp(packet, format="raw"):
+    """Return (sequence number, send time in ns) of a test packet"""
+    if format == "json":
+        msg = json.loads(bytes(packet))
+        return msg["message_id"], msg["t_ns"]
+    return stamp.unpack_from(packet)
+
+
+def parse_mix(mix):
+    """Parse a topic mix "tracking:0.8,control:0.2" into
+    (names, normalised weights)"""
+    names, weights = [], []
+    for part in mix.split(","):
+        name, _, weight = part.partition(":")
+        names.append(name)
+        weights.append(float(weight or 1.0))
+    weights = np.array(weights) / np.sum(weights)
+    return names, weights
+
+
+def publish_load(
+    address="tcp://127.0.0.1:5556",
+    rate=2.0,
+    size=0,
+    mix="demo",
+    pattern="steady",
+    burst=1,
+    format="json",
+    duration=None,
+    verbose=False,
+):
+    """Publish timestamped packets at `rate` packets/s.
+
+    pattern="steady" sends evenly spaced packets, "burst" sends
+    `burst` packets back to back at rate/burst bursts/s, and
+    "poisson" uses exponentially distributed gaps. Each packet's
+    topic is drawn from the weighted mix. Returns the number of
+    packets sent per topic."""
     ctx = zmq.Context()
     sock = ctx.socket(zmq.PUB)
+    sock.setsockopt(zmq.SNDHWM, 0)
     print(f"Opening ZMQ pub on {address}")
     sock.bind(address)
-    time.sleep(0.1)
-
-    i = 0
-    while True:
-        sock.send_multipart([topic, json.dumps({"message_id": i}).encode("utf8")])
-        print(topic, i)
-        i += 1
-        time.sleep(0.5)
+    # give subscribers time to connect
+    time.sleep(0.5)
+
+    names, weights = parse_mix(mix)
+    topics = [name.encode("utf8") for name in names]
+    rng = np.random.default_rng()
+    burst = burst if pattern == "burst" else 1
+    interval = burst / rate
+    start = next_t = time.perf_counter()
+    seqs = [0] * len(topics)
+    try:
+        while duration is None or next_t - start < duration:
+            picks = rng.choice(len(topics), size=burst, p=weights)
+            for pick in picks:
+                seq = seqs[pick]
+                sock.send_multipart([topics[pick], make_packet(seq, size, format)])
+                if verbose:
+                    print(names[pick], seq)
+                seqs[pick] = seq + 1
+            if pattern == "poisson":
+                next_t += rng.exponential(interval)
+            else:
+                next_t += interval
+            delay = next_t - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+    finally:
+        sock.close()
+        ctx.term()
+    return dict(zip(names, seqs))
+
+
+def bench_relay(
+    topics=("demo",),
+    endpoints=None,
+    duration=10.0,
+    frame_ms=16.7,
+    format="json",
+    **relay_args,
+):
+    """Read from a Relay once per simulated frame, and report
+    throughput, drops and publish -> drain() latency"""
+    relay = Relay(topics=topics, endpoints=endpoints, **relay_args)
+    latencies = []
+    seqs = {name: [] for name in relay.topics}
+    start = time.perf_counter()
+    try:
+        while time.perf_counter() - start < duration:
+            time.sleep(frame_ms / 1000.0)
+            for name, packets in relay.drain_all().items():
+                now = time.perf_counter_ns()
+                for packet in packets:
+                    seq, t = read_stamp(packet, format)
+                    seqs[name].append(seq)
+                    latencies.append(now - t)
+        elapsed = time.perf_counter() - start
+        stats = relay.stats()
+    finally:
+        relay.close()
+
+    if not latencies:
+        print("No packets received")
+        return
+    latencies = np.array(latencies) / 1e6
+    received = len(latencies)
+    p50, p99, p999 = np.percentile(latencies, [50, 99, 99.9])
+    print(f"Received {received} packets in {elapsed:.2f}s ({received/elapsed:.0f}/s)")
+    for name, topic_seqs in seqs.items():
+        if not topic_seqs:
+            print(f"{name}: no packets")
+            continue
+        topic_seqs = np.array(topic_seqs)
+        # packets lost anywhere between publisher and drain()
+        lost = topic_seqs.max() - topic_seqs.min() + 1 - len(np.unique(topic_seqs))
+        s = stats[name]
+        print(
+            f"{name}: received {len(topic_seqs)}, lost {lost} "
+            f"({s['dropped'] + s['oversize']} dropped by the relay ring)"
+        )
+    print(
+        f"Latency ms: p50 {p50:.3f} p99 {p99:.3f} p99.9 {p999:.3f} max {latencies.max():.3f}"
+    )
+
+
+if __name__ == "__main__":
+    # publish test packets (the default), or benchmark the relay against
+    # a publisher running in another terminal, e.g.
+    #   python zmq_relay.py pub --rate 5000 --size 256 --mix tracking:0.9,control:0.1
+    #   python zmq_relay.py bench --topic tracking --topic control --backend thread
+    import argparse
+
+    parser = argparse.ArgumentParser(description="ZMQ relay load generator/benchmark")
+    parser.add_argument("mode", nargs="?", default="pub", choices=["pub", "bench"])
+    parser.add_argument("--address", default="tcp://127.0.0.1:5556")
+    parser.add_argument("--format", default="json", choices=["json", "raw"])
+    parser.add_argument("--duration", type=float, default=None, help="Seconds to run")
+    parser.add_argument("--rate", type=float, default=2.0, help="Packets per second")
+    parser.add_argument("--size", type=int, default=0, help="Minimum packet bytes")
+    parser.add_argument("--mix", default="demo", help="Topic mix, e.g. a:0.9,b:0.1")
+    parser.add_argument(
+        "--pattern", default="steady", choices=["steady", "burst", "poisson"]
+    )
+    parser.add_argument("--burst", type=int, default=10, help="Packets per burst")
+    parser.add_argument("--topic", action="append", help="Topics to bench")
+    parser.add_argument("--backend", default="process", choices=backends)
+    parser.add_argument("--frame_ms", type=float, default=16.7)
+    parser.add_argument("--slots", type=int, default=2048)
+    parser.add_argument("--slot_size", type=int, default=8192)
+    parser.add_argument("--policy", default="drop_oldest")
+    args = parser.parse_args()
+
+    if args.mode == "pub":
+        publish_load(
+            args.address,
+            rate=args.rate,
+            size=args.size,
+            mix=args.mix,
+            pattern=args.pattern,
+            burst=args.burst,
+            format=args.format,
+            duration=args.duration,
+            verbose=args.rate <= 10,
+        )
+    else:
+        bench_relay(
+            topics=args.topic or ["demo"],
+            endpoints=[args.address],
+            duration=args.duration or 10.0,
+            frame_ms=args.frame_ms,
+            format=args.format,
+            backend=args.backend,
+            n_slots=args.slots,
+            slot_size=args.slot_size,
+            policy=args.policy,
+        )